@@ -1,11 +1,14 @@
 
 
+import json
+import threading
 import globalPluginHandler
 import gui
 import wx
 import addonHandler
 import globalVars
 import config
+import synthDriverHandler
 from logHandler import log
 from .constants import *
 from . import updater
@@ -64,6 +67,38 @@ class GlobalPlugin(globalPluginHandler.GlobalPlugin):
         gui.mainFrame.sysTrayIcon.Bind(
             wx.EVT_MENU, self.performUpdateCheck, self.updateCheckPerformItem)
 
+        self.showStatisticsItem = self.rootMenu.Append(
+            wx.ID_ANY,
+            _("Show performance statistics"),
+            _("Shows how long speech synthesis has been taking.")
+        )
+        gui.mainFrame.sysTrayIcon.Bind(
+            wx.EVT_MENU, self.showStatistics, self.showStatisticsItem)
+
+        self.exportStatisticsItem = self.rootMenu.Append(
+            wx.ID_ANY,
+            _("Export performance statistics..."),
+            _("Saves the performance statistics to a JSON file.")
+        )
+        gui.mainFrame.sysTrayIcon.Bind(
+            wx.EVT_MENU, self.exportStatistics, self.exportStatisticsItem)
+
+        self.exportTraceItem = self.rootMenu.Append(
+            wx.ID_ANY,
+            _("Export speech trace..."),
+            _("Saves the recorded speech processing steps to a Chrome trace file.")
+        )
+        gui.mainFrame.sysTrayIcon.Bind(
+            wx.EVT_MENU, self.exportTrace, self.exportTraceItem)
+
+        self.calibrateEngineItem = self.rootMenu.Append(
+            wx.ID_ANY,
+            _("Calibrate engine threads..."),
+            _("Finds the number of CPU threads with which the engine started by VSU synthesizes fastest.")
+        )
+        gui.mainFrame.sysTrayIcon.Bind(
+            wx.EVT_MENU, self.calibrateEngine, self.calibrateEngineItem)
+
         self.rootMenuItem = gui.mainFrame.sysTrayIcon.menu.Insert(
             2, wx.ID_ANY, _("VSU"), self.rootMenu)
 
@@ -80,6 +115,86 @@ class GlobalPlugin(globalPluginHandler.GlobalPlugin):
     def performUpdateCheck(self, evt):
         updater.AutoUpdateChecker().autoUpdateCheck(mode=updater.MANUAL)
 
+    def getVSU(self, title):
+        synth = synthDriverHandler.getSynth()
+        if synth is None or synth.name != "VSU":
+            gui.messageBox(_("VSU is not the current synthesizer."), title)
+            return None
+        return synth
+
+    def showStatistics(self, evt):
+        synth = self.getVSU(_("Performance statistics"))
+        if synth is None:
+            return
+        if not synth.getStatistics()["counters"]["utterances"]:
+            gui.messageBox(_("Nothing has been spoken yet."), _("Performance statistics"))
+            return
+        gui.messageBox(synth.getStatisticsText(), _("Performance statistics"))
+
+    def exportStatistics(self, evt):
+        synth = self.getVSU(_("Performance statistics"))
+        if synth is None:
+            return
+        self.saveJson(_("Export performance statistics"), "VSU_statistics.json", synth.getStatistics(), indent=2)
+
+    def exportTrace(self, evt):
+        synth = self.getVSU(_("Speech trace"))
+        if synth is None:
+            return
+        trace = synth.getTrace()
+        if trace is None:
+            gui.messageBox(_("Speech tracing is off. Set traceSize in the VSU_synth section of nvda.ini to record it."), _("Speech trace"))
+            return
+        self.saveJson(_("Export speech trace"), "VSU_trace.json", trace)
+
+    def calibrateEngine(self, evt):
+        synth = self.getVSU(_("Engine calibration"))
+        if synth is None:
+            return
+        if not synth.isEngineManaged():
+            gui.messageBox(_("The engine is not started by VSU. Set engineCommand in the VSU_synth section of nvda.ini to let VSU start it."), _("Engine calibration"))
+            return
+        if gui.messageBox(_("The engine will be started several times to measure its speed. This may take a few minutes, and speech may be slow meanwhile. Continue?"), _("Engine calibration"), wx.YES_NO | wx.ICON_QUESTION) != wx.YES:
+            return
+        threading.Thread(target=self._calibrateEngine, args=(synth,), name="VSU.CalibrationThread", daemon=True).start()
+
+    def _calibrateEngine(self, synth):
+        try:
+            threads, results = synth.calibrateEngine()
+        except Exception as e:
+            log.error("Engine calibration failed", exc_info=True)
+            wx.CallAfter(gui.messageBox, str(e), _("Error"))
+            return
+        lines = [_("The engine now uses %d CPU threads.") % threads]
+        for count, ratio in sorted(results.items()):
+            if ratio is None:
+                lines.append(_("%d threads: failed") % count)
+            else:
+                lines.append(_("%d threads: real-time factor %.3f") % (count, ratio))
+        wx.CallAfter(gui.messageBox, "\n".join(lines), _("Engine calibration"))
+
+    def saveJson(self, title, defaultFile, data, indent=None):
+        gui.mainFrame.prePopup()
+        dialog = wx.FileDialog(
+            gui.mainFrame,
+            title,
+            defaultFile=defaultFile,
+            wildcard="JSON (*.json)|*.json",
+            style=wx.FD_SAVE | wx.FD_OVERWRITE_PROMPT
+        )
+        result = dialog.ShowModal()
+        path = dialog.GetPath()
+        dialog.Destroy()
+        gui.mainFrame.postPopup()
+        if result != wx.ID_OK:
+            return
+        try:
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False, indent=indent)
+        except OSError as e:
+            log.error("Failed to export %s" % defaultFile, exc_info=True)
+            gui.messageBox(str(e), _("Error"))
+
     def getUpdateCheckSetting(self):
         return config.conf["VSU_global"]["checkForUpdatesOnStartup"]
 
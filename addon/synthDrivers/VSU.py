@@ -2,11 +2,14 @@
 # Copyright (C) 2023 yamahubuki, ACT Laboratory
 
 import wx
+from collections import OrderedDict
 from . import _vsu
+from . import _vsuStats
 import addonHandler
 import gui
 from synthDriverHandler import SynthDriver, synthIndexReached, synthDoneSpeaking
-from autoSettingsUtils.driverSetting import BooleanDriverSetting, NumericDriverSetting
+from autoSettingsUtils.driverSetting import BooleanDriverSetting, DriverSetting, NumericDriverSetting
+from autoSettingsUtils.utils import StringParameterInfo
 import speech
 from logHandler import log
 from speech.commands import (
@@ -34,6 +37,8 @@ class SynthDriver(SynthDriver):
 		SynthDriver.PitchSetting(),
 		SynthDriver.InflectionSetting(),
 		SynthDriver.VolumeSetting(),
+		BooleanDriverSetting("streaming", _("&Streaming synthesis"), defaultVal=True),
+		DriverSetting("quality", _("Output &quality"), defaultVal="24000"),
 	)
 	supportedCommands = {
 		IndexCommand,
@@ -89,6 +94,25 @@ class SynthDriver(SynthDriver):
 	def _set_volume(self, volume):
 		return _vsu.setVolume(volume)
 
+	def _get_streaming(self):
+		return _vsu.getStreaming()
+
+	def _set_streaming(self, streaming):
+		_vsu.setStreaming(streaming)
+
+	def _get_availableQualitys(self):
+		return OrderedDict((
+			("24000", StringParameterInfo("24000", _("High (24 kHz)"))),
+			("16000", StringParameterInfo("16000", _("Fast (16 kHz)"))),
+			("12000", StringParameterInfo("12000", _("Fastest (12 kHz)"))),
+		))
+
+	def _get_quality(self):
+		return _vsu.getQuality()
+
+	def _set_quality(self, quality):
+		_vsu.setQuality(quality)
+
 
 	def _onIndexReached(self, index):
 		if index is not None:
@@ -111,6 +135,21 @@ class SynthDriver(SynthDriver):
 	def isSpeaking(self):
 		return _vsu.isSpeaking
 
+	def getStatistics(self):
+		return _vsu.getStats()
+
+	def getStatisticsText(self):
+		return "\n".join(_vsuStats.formatSummary(_vsu.getStats()))
+
+	def getTrace(self):
+		return _vsu.getTrace()
+
+	def isEngineManaged(self):
+		return _vsu.isEngineManaged()
+
+	def calibrateEngine(self):
+		return _vsu.calibrateEngine()
+
 def errmsg(e):
 	msgs = [
 		_("Failed to load VSU."),
@@ -2,35 +2,166 @@
 # Copyright (c)2022 Hiroki Fujii,ACT laboratory All rights reserved.
 # Copyright (C) 2023 yamahubuki, ACT Laboratory
 
+import audioop
+import ctypes
+import io
 import json
-import re
+import os
 import requests
+import socket
+import string
 import time
 import nvwave
 import threading
 import queue
-from collections import OrderedDict
+import zipfile
+from collections import OrderedDict, deque
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
 from synthDriverHandler import VoiceInfo
 from speech.commands import IndexCommand, BreakCommand, PitchCommand
 import config
+import globalVars
 from logHandler import log
+from . import _vsuAudio
+from . import _vsuCache
+from . import _vsuDiskCache
+from . import _vsuEngine
+from . import _vsuNormalizer
+from . import _vsuStats
+from . import _vsuSupervisor
+from . import _vsuText
+from . import _vsuTrace
+from . import _vsuUserDict
 
 import urllib.request
 import urllib.parse
 
 
 SAMPLE_RATE = 24000
+# ストリーミング合成時に1回で送る最大モーラ数
+STREAM_MAX_MORA = 40
+# 合成済みで再生待ちにしておける音声の最大数
+PLAY_QUEUE_SIZE = 16
+# 合成結果を受信しながら再生に回す単位(バイト)
+STREAM_BLOCK_SIZE = 32768
+# これより長い音声はキャッシュしない(バイト)。1発声あたりのメモリ使用量の上限にもなる
+MAX_CACHED_WAVE = 4 * 1024 * 1024
+# 受信した音声を再生まで置いておくバッファの大きさ(バイト)
+PCM_RING_SIZE = 1024 * 1024
+# 無音の挿入に使い回す、1秒分(24kHz)の無音
+SILENCE = bytearray(SAMPLE_RATE * 2)
 
-preprocess_patterns = [
-	(re.compile(r" {2,}"), " "),
-	(re.compile(r"\?"), "？"),
+confspec = {
+	# 利用するVoicevoxエンジンのアドレス。複数指定すると、空いているエンジンに振り分ける
+	"endpoints": "string_list(default=list('localhost:50021'))",
+	# 合成済み音声をメモリに保持する量(MB)
+	"waveCacheSize": "integer(default=16, min=0, max=1024)",
+	# 話速などを変えたときに再利用するaudio_queryの結果の数
+	"queryCacheSize": "integer(default=1024, min=0, max=65536)",
+	# 起動時や話者の変更時に、事前に読み込ませておく最近使った話者の数
+	"warmupStyles": "integer(default=3, min=0, max=16)",
+	"recentStyles": "string_list(default=list())",
+	# 続けて読み上げる短い文字列を、/multi_synthesisでまとめて合成する最大数。1以下ならまとめない
+	"batchSize": "integer(default=8, min=0, max=64)",
+	# 空白・句読点で区切った断片ごとに再利用するアクセント句の数。0なら文字列全体でaudio_queryを行う
+	"phraseCacheSize": "integer(default=4096, min=0, max=65536)",
+	# NVDAの再起動後も使えるよう、合成済み音声をディスクに保持する量(MB)。0なら保持しない
+	"diskCacheSize": "integer(default=64, min=0, max=4096)",
+	# 出力品質ごとの計測値をログに出す間隔(発声数)。0なら出さない
+	"qualityLogInterval": "integer(default=0, min=0, max=10000)",
+	# 合成した音声の前後から取り除く無音の振幅の上限(最大32767)。0なら取り除かない
+	"silenceThreshold": "integer(default=0, min=0, max=32767)",
+	# 無音を取り除くときに、音の前後に残す長さ(ミリ秒)
+	"silenceGuard": "integer(default=10, min=0, max=1000)",
+	# 全角英数字や半角カナなどを、NFKC正規化でまとめてからエンジンに送る
+	"normalizeWidth": "boolean(default=True)",
+	# インデックスで区切られた短い文字列をまとめて合成し、インデックスは音声の途中で通知する
+	"joinIndexes": "boolean(default=False)",
+	# 性能の統計をログに出す間隔(秒)。0なら出さない
+	"statsLogInterval": "integer(default=0, min=0, max=86400)",
+	# stop()が短い間隔で続いているとき、次の文字列を合成する前に、さらにstop()されないか待つ時間(ミリ秒)。0なら待たない
+	"admissionWindow": "integer(default=50, min=0, max=1000)",
+	# 入力した文字の読み上げ用に、かな・英数字・記号1文字の音声を、話者や設定ごとにあらかじめ合成しておく
+	"charTable": "boolean(default=True)",
+	# 読み上げの処理の区間を記録しておく数。0なら記録しない
+	"traceSize": "integer(default=0, min=0, max=1000000)",
+	# VSUが起動して管理するエンジンの実行ファイル(run.exe)。指定するとendpointsの代わりにこのエンジンを使う。空なら起動しない
+	"engineCommand": "string(default='')",
+	# 管理するエンジンに渡す追加のオプション。空白で区切る
+	"engineArgs": "string(default='--enable_cancellable_synthesis')",
+	# 管理するエンジンが合成に使うCPUのスレッド数。0なら論理コア数の半分
+	"engineThreads": "integer(default=0, min=0, max=256)",
+	# 管理するエンジンのメモリ使用量がこれ(MB)を超えたら、読み上げていないときに再起動する。0なら監視しない
+	"engineMemoryLimit": "integer(default=0, min=0, max=65536)",
+}
+config.conf.spec["VSU_synth"] = confspec
+
+# 話者を読み込ませた後に合成しておく文
+WARMUP_TEXT = "こんにちは"
+# /accent_phrasesの結果からaudio_queryを組み立てるときの既定値
+QUERY_TEMPLATE = {
+	"speedScale": 1.0,
+	"pitchScale": 0.0,
+	"intonationScale": 1.0,
+	"volumeScale": 1.0,
+	"prePhonemeLength": 0.1,
+	"postPhonemeLength": 0.1,
+	"outputSamplingRate": SAMPLE_RATE,
+	"outputStereo": False,
+}
+
+# エンジンに送る前に書き換える規則。置換先には文字列か、マッチを受け取る関数を指定する
+PREPROCESS_RULES = [
+	(r" {2,}", " "),
+	(r"\?", "？"),
 ]
+# 利用者が用意する読みの辞書。1行に1語、単語と読みをタブで区切る
+READINGS_FILE = "readings.txt"
+# エンジンのユーザー辞書に登録する単語。1行に1語、表記・読み(カタカナ)・アクセント型をタブで区切る
+USER_DICT_FILE = "userdict.txt"
+# 各エンジンに最後に送ったユーザー辞書の内容
+USER_DICT_STATE_FILE = "userdict_state.json"
+# 読み上げ中にユーザー辞書の変更を確認する間隔(秒)
+USER_DICT_CHECK_INTERVAL = 5.0
+# 最後にエンジンから取得した話者の一覧。次回はこれを使ってすぐに起動する
+SPEAKERS_FILE = "speakers.json"
+# 起動時にエンジンへの接続を試みる間隔の上限(秒)
+CONNECT_RETRY_MAX = 10.0
+# 管理するエンジンの出力を書き込むファイル
+ENGINE_LOG_FILE = "engine.log"
+# 話者の一覧を保存していないときに、管理するエンジンの起動を待つ時間(秒)
+ENGINE_START_TIMEOUT = 120.0
+# 中断できる合成で、エンジンが合成に使う子プロセスの数(--init_processesの既定値)
+CANCELLABLE_WORKERS = 2
+# 1文字の音声の表に入れる文字。ひらがな・カタカナ・英小文字・数字・よく使う記号
+# 英大文字は、NVDAが高さを変えて(PitchCommand)送ってくるので、基準の高さで作っても使われない
+CHAR_TABLE_TEXTS = (
+	[chr(code) for code in range(0x3041, 0x3097)]
+	+ [chr(code) for code in range(0x30a1, 0x30fb)]
+	+ list(string.ascii_lowercase + string.digits)
+	+ list("ー、。・「」（）！？!?.,:;-_/()[]{}@#$%&*+=<>~'\"")
+)
+# 1文字の音声の表を作るときに、1回の/multi_synthesisで合成する文字の数
+CHAR_TABLE_BATCH = 16
 
 isSpeaking = False
 onIndexReached = None
+# エンジンから話者の一覧を取得でき、合成を始められるようになったらセットされる
+engineReady = threading.Event()
+_shuttingDown = threading.Event()
 bgThread = None
 bgQueue = None
+playThread = None
+playQueue = None
 player = None
+# エンジンに要求するサンプリングレートと、playerを開いたサンプリングレート
+samplingRate = SAMPLE_RATE
+playerRate = SAMPLE_RATE
+# サンプリングレートを変換しながら再生するときの、audioop.ratecvの状態
+_resampleState = None
+# サンプリングレートごとの計測値
+_qualityStats = {}
 rate = 50
 pitch = 50
 temporaryPitch = 50
@@ -39,96 +170,658 @@ volume = 100
 voice = "1"
 voices_cash = None
 session = None
+retryPolicy = _vsuEngine.RetryPolicy()
+endpointPool = _vsuEngine.EndpointPool(["localhost:50021"])
+healthProbe = None
+supervisor = None
+warmThread = None
+warmQueue = None
+waveCache = None
+queryCache = None
+phraseCache = None
+diskCache = None
+pcmRing = None
+normalizer = _vsuNormalizer.Normalizer(PREPROCESS_RULES, nfkc=False)
+# 再生中の音声をplayerが参照している間、バッファを解放させないために保持する
+_fedBuffers = deque(maxlen=4)
+streaming = True
+batchSize = 8
+joinIndexes = False
+silenceThreshold = 0
+silenceGuard = 10
+# エンジンに送ったユーザー辞書の内容のハッシュ。キャッシュのキーに含める
+userDictHash = None
+_userDictMtime = None
+_userDictChecked = 0
+# 性能の統計。時間はミリ秒
+stats = _vsuStats.Recorder({
+	"audioQueryMs": _vsuStats.TIME_BOUNDS,
+	"synthesisMs": _vsuStats.TIME_BOUNDS,
+	"firstAudioMs": _vsuStats.TIME_BOUNDS,
+	"utteranceMs": _vsuStats.TIME_BOUNDS,
+	"realTimeFactor": _vsuStats.RATIO_BOUNDS,
+	"synthesisQueue": _vsuStats.DEPTH_BOUNDS,
+	"playQueue": _vsuStats.DEPTH_BOUNDS,
+	"utteranceBytes": _vsuStats.SIZE_BOUNDS,
+	"admissionMs": _vsuStats.TIME_BOUNDS,
+}, ("utterances", "bytes", "debounced", "flushed"))
+_statsLogged = time.monotonic()
+tracer = _vsuTrace.Tracer()
+# 取り除いた無音の長さ(ミリ秒)の合計
+_trimStats = {"waves": 0, "trimmedMs": 0.0}
+admissionWindow = 50
+# (文字, 話者, 設定...)から、その文字の音声への表。現在の設定の分だけを持つ
+charTable = {}
+charTableEnabled = True
+_charTableScheduled = False
+_charTableStats = {"hits": 0, "misses": 0}
+# 最後にstop()された時刻と、その前のstop()からの間隔
+_lastStop = 0.0
+_stopInterval = float("inf")
+_stopCondition = threading.Condition()
+# stop()のたびに加算し、読み上げ途中の文章の続きを捨てるために使う
+generation = 0
+# 合成スレッドが処理中の文章を受け付けたときのgeneration
+_synthGeneration = 0
+# エンジンが--enable_cancellable_synthesisで起動されていれば、/cancellable_synthesisを使う
+cancellableSynthesis = True
+# スレッドごとの、エンジンとの通信に使用中の接続
+_activeConnections = {}
+_activeConnectionsLock = threading.Lock()
+# 直近の発声にかかった時間(秒)。firstAudioが最初の音を渡すまで、totalが最後の音を渡すまで
+lastTiming = None
+
+class SynthesisCancelled(Exception):
+	"""Raised in the synthesis thread when stop() abandons the text being synthesized."""
+
+
+class _TrackedConnectionPool(HTTPConnectionPool):
+	# stop()から通信中の接続を切れるよう、スレッドごとに使用中の接続を記録する
+	def _get_conn(self, timeout=None):
+		conn = super()._get_conn(timeout)
+		with _activeConnectionsLock:
+			_activeConnections[threading.get_ident()] = conn
+		return conn
+
+	def _put_conn(self, conn):
+		with _activeConnectionsLock:
+			_activeConnections.pop(threading.get_ident(), None)
+		super()._put_conn(conn)
+
+
+class _CancellableAdapter(HTTPAdapter):
+	def init_poolmanager(self, *args, **kwargs):
+		super().init_poolmanager(*args, **kwargs)
+		self.poolmanager.pool_classes_by_scheme = {"http": _TrackedConnectionPool, "https": HTTPSConnectionPool}
+
 
 class BgThread(threading.Thread):
-	def __init__(self):
+	"""Runs functions put in the given queue one by one.
+
+	bgQueue feeds the synthesis stage and playQueue feeds the playback stage.
+	"""
+
+	def __init__(self, queue, name="BgThread"):
 		super().__init__(
-			name=f"{self.__class__.__module__}.{self.__class__.__qualname__}")
+			name=f"{self.__class__.__module__}.{name}")
 		self.setDaemon(True)
+		self.queue = queue
 
 	def run(self):
 		while True:
-			func, args, kwargs = bgQueue.get()
+			func, args, kwargs = self.queue.get()
 			if not func:
 				break
 			try:
-				func(*args, **kwargs)
+				with tracer.span(func.__name__):
+					func(*args, **kwargs)
 			except BaseException as e:
 				print(e)
 				log.error("Error running function from queue", exc_info=True)
-			bgQueue.task_done()
+			self.queue.task_done()
 
 
 def _execWhenDone(func, *args, mustBeAsync=False, **kwargs):
 	global bgQueue
-	if mustBeAsync or bgQueue.unfinished_tasks != 0:
+	if mustBeAsync or bgQueue.unfinished_tasks != 0 or playQueue.unfinished_tasks != 0:
 		# Either this operation must be asynchronous or There is still an operation in progress.
 		# Therefore, run this asynchronously in the background thread.
 		bgQueue.put((func, args, kwargs))
 	else:
 		func(*args, **kwargs)
 
-def _speak(text):
+
+def _execWhenPlayed(func, *args, **kwargs):
+	# 再生スレッドに渡し、それまでに合成された音声の後で実行させる
+	# 再生待ちが一杯の場合は、空くまで合成スレッドを待たせる
+	playQueue.put((func, args, kwargs))
+
+
+def _flushQueue(q, funcs):
+	# funcsに含まれる処理をキューから取り除く。それ以外の処理は順序を保ったまま残す
+	# 取り除いた処理のリストを返す
+	with q.mutex:
+		kept = [item for item in q.queue if item[0] not in funcs]
+		removed = [item for item in q.queue if item[0] in funcs]
+		q.unfinished_tasks -= len(q.queue) - len(kept)
+		q.queue.clear()
+		q.queue.extend(kept)
+		q.not_full.notify_all()
+		if q.unfinished_tasks == 0:
+			q.all_tasks_done.notify_all()
+	return removed
+
+def _preprocess(text):
 	# When set not to read symbols, NVDA sends blank string. Directly passing it makes fs2 dll crash.
 	if text == "  ":
-		return
+		return None
 	# end
-	global isSpeaking
+	return normalizer.normalize(text)
+
+
+def _split(text):
+	if streaming:
+		return _vsuText.splitClauses(text, STREAM_MAX_MORA)
+	return [text]
+
+
+def _speak(text):
+	text = _preprocess(text)
+	if text is None:
+		return
+	global isSpeaking, _synthGeneration
 	isSpeaking = True
-	for elem in preprocess_patterns:
-		text = re.sub(elem[0], elem[1], text)
-	# end replace
+	# 後でgenerationを読み直すと、その間にstop()されたことに気づけないので、ここで1回だけ読む
+	gen = _synthGeneration = generation
+
+	chunks = _split(text)
+	if not chunks:
+		# 空白や改行だけの文字列
+		return
+	if not _admit(chunks[0]):
+		return
+	if len(chunks) == 1 and batchSize > 1:
+		batch = _collectBatch()
+		if batch:
+			_speakBatch(chunks[0], batch, gen)
+			return
+	timing = _newTiming(time.perf_counter(), len(chunks))
+	for i, chunk in enumerate(chunks):
+		try:
+			for wave, region in iterWave(chunk):
+				if gen != generation:
+					_releaseRegion(region)
+					break
+				_execWhenPlayed(_play, wave, gen, timing, region)
+		except SynthesisCancelled:
+			break
+		except Exception as e:
+			log.error(e)
+			isSpeaking = False
+			raise e
+		if gen != generation:
+			# stop()された
+			break
+		if i + 1 < len(chunks):
+			# 区切って合成すると句読点の後の間がなくなるので、無音で補う
+			_playSilence(_vsuText.boundaryPause(chunk) * 50 / (rate + 20), gen)
+	_execWhenPlayed(_finishTiming, timing, gen)
+
+
+def _admit(text):
+	# 合成スレッドで、エンジンに問い合わせる前に呼ばれる。合成をやめるときはFalseを返す
+	# キーを押し続けたときのように、stop()が短い間隔で続いている間は、すぐに置き換えられる文字列を合成しないよう
+	# 最後のstop()からadmissionWindowが過ぎるまで待つ
+	window = admissionWindow / 1000
+	if not window or _stopInterval >= window:
+		return True
+	if text is not None:
+		key = _cacheKey(text)
+		if key in charTable or key in waveCache:
+			# エンジンに問い合わせずに済むので、待たない
+			return True
+	start = time.monotonic()
+	with _stopCondition:
+		while _synthGeneration == generation:
+			remaining = _lastStop + window - time.monotonic()
+			if remaining <= 0:
+				stats.observe("admissionMs", (time.monotonic() - start) * 1000)
+				return True
+			_stopCondition.wait(remaining)
+	# 待っている間にstop()された
+	stats.add("debounced")
+	return False
+
+
+class _JoinedText:
+	"""Strings of a speech sequence with the indexes between them, synthesized as one audio query."""
+
+	def __init__(self):
+		# [文字列, その後ろにあるインデックスのリスト]のリスト
+		self.pieces = []
+		self.items = []
+		self.mora = 0
+
+
+def _joinIndexedText(speechSequence):
+	# 文字列とインデックスだけが続く部分を、STREAM_MAX_MORAに収まる範囲でまとめる
+	ret = []
+	joined = _JoinedText()
+
+	def flush():
+		nonlocal joined
+		if len(joined.pieces) > 1:
+			ret.append(joined)
+		else:
+			ret.extend(joined.items)
+		joined = _JoinedText()
 
+	for item in speechSequence:
+		if isinstance(item, str):
+			mora = _vsuText.estimateMora(item)
+			if joined.pieces and joined.mora + mora > STREAM_MAX_MORA:
+				flush()
+			if mora > STREAM_MAX_MORA:
+				# 長い文字列は、これまでどおり区切って合成する
+				ret.append(item)
+				continue
+			joined.pieces.append([item, []])
+			joined.items.append(item)
+			joined.mora += mora
+		elif isinstance(item, IndexCommand) and joined.pieces:
+			joined.pieces[-1][1].append(item.index)
+			joined.items.append(item)
+		else:
+			flush()
+			ret.append(item)
+	flush()
+	return ret
+
+
+def _speakJoined(pieces):
+	global isSpeaking, _synthGeneration
+	isSpeaking = True
+	gen = _synthGeneration = generation
+	if not _admit(None):
+		return
+	texts = [_preprocess(text) or "" for text, indexes in pieces]
 	try:
-		wave = getWave(text)
+		# 文字列ごとに解析したアクセント句をつなげ、文字列の境目の位置を音声の中の位置に換算する
+		# 別々に読み上げたときのように、文字列の間には句読点がなくても間を入れる
+		phrases = []
+		boundaries = []
+		for i, text in enumerate(texts):
+			textPhrases = _segmentPhrases(_vsuText.splitSegments(text))
+			if i + 1 < len(texts):
+				pause = _vsuText.boundaryPause(text) or _vsuText.PAUSE_LENGTHS["、"]
+				textPhrases = _vsuText.withBoundaryPause(textPhrases, text, pause)
+			phrases.extend(textPhrases)
+			boundaries.append(len(phrases))
+		query = dict(QUERY_TEMPLATE)
+		query["accent_phrases"] = phrases
+		query = _applyProsody(query)
+		offsets = _vsuAudio.phraseOffsets(query)
+		marks = []
+		for boundary, (text, indexes) in zip(boundaries, pieces):
+			marks.extend((offsets[boundary], index) for index in indexes)
+		timing = _newTiming(time.perf_counter(), 1)
+		position = 0
+		if phrases:
+			key = _cacheKey("\n".join(texts)) + (tuple(boundaries),)
+			for wave, region in iterWave(None, query, key):
+				if gen != generation:
+					_releaseRegion(region)
+					break
+				# この音声の範囲に入るインデックスを、音声の先頭からの位置にして渡す
+				end = position + len(wave)
+				waveMarks = [(offset - position, index) for offset, index in marks if position < offset <= end]
+				marks = [mark for mark in marks if mark[0] > end]
+				_execWhenPlayed(_play, wave, gen, timing, region, waveMarks)
+				position = end
+	except SynthesisCancelled:
+		return
 	except Exception as e:
 		log.error(e)
 		isSpeaking = False
 		raise e
-	player.feed(wave,onDone=None)
-	player.idle()
-	isSpeaking = False
+	if gen != generation:
+		return
+	# 計算した位置が音声の長さを超えたものや、音声の前にあるものは、最後に通知する
+	for offset, index in marks:
+		_execWhenPlayed(_onIndex, index)
+	_execWhenPlayed(_finishTiming, timing, gen)
+
+
+def _collectBatch():
+	# 合成待ちの先頭に続けて並んでいる短い文字列と、その間のインデックスを取り出す
+	# 取り出した分のtask_done()は_speakBatchで呼ぶ
+	batch = []
+	texts = 1
+	with bgQueue.mutex:
+		while bgQueue.queue and texts < batchSize:
+			func, args, kwargs = bgQueue.queue[0]
+			if func is _speak:
+				text = _preprocess(args[0])
+				if text is not None:
+					if len(_split(text)) != 1:
+						break
+					texts += 1
+				batch.append((text, None))
+			elif func is _execWhenPlayed and args[0] is _onIndex:
+				batch.append((None, (func, args, kwargs)))
+			else:
+				break
+			bgQueue.queue.popleft()
+	# 後ろに文字列が続かないインデックスは、取り出さなくてもよかった分なので戻す
+	while batch and batch[-1][1] is not None:
+		with bgQueue.mutex:
+			bgQueue.queue.appendleft(batch.pop()[1])
+	return batch
+
+
+def _speakBatch(text, batch, gen):
+	start = time.perf_counter()
+	try:
+		texts = [text] + [item[0] for item in batch if item[0] is not None]
+		waves = {}
+		missing = []
+		for t in texts:
+			wave = _findWave(_cacheKey(t))
+			if wave is not None:
+				waves[t] = wave
+			elif t not in missing:
+				missing.append(t)
+		if len(missing) > 1:
+			try:
+				for t, wave in zip(missing, getMultiWave(missing)):
+					_storeWave(_cacheKey(t), wave)
+					waves[t] = wave
+			except SynthesisCancelled:
+				pass
+			except Exception:
+				# /multi_synthesisに対応していないエンジンなど。1つずつ合成する
+				log.debug("multi synthesis failed", exc_info=True)
+		for item in [(text, None)] + batch:
+			if item[1] is not None:
+				_execWhenPlayed(*item[1][1], **item[1][2])
+				continue
+			if item[0] is None or gen != generation:
+				continue
+			try:
+				wave = waves.get(item[0])
+				if wave is None:
+					wave = getCachedWave(item[0])
+			except SynthesisCancelled:
+				continue
+			except Exception:
+				log.error("Error synthesizing %r" % item[0], exc_info=True)
+				continue
+			if gen != generation:
+				continue
+			timing = _newTiming(start, 1)
+			_execWhenPlayed(_play, wave, gen, timing)
+			_execWhenPlayed(_finishTiming, timing, gen)
+	finally:
+		for item in batch:
+			bgQueue.task_done()
+
+
+def _newTiming(start, chunks):
+	return {
+		"start": start,
+		"firstAudio": None,
+		"total": None,
+		"chunks": chunks,
+		"samplingRate": samplingRate,
+		"bytes": 0,
+	}
+
+
+def _play(wave, gen, timing=None, region=None, marks=()):
+	# 再生スレッドで実行される
+	# marksは(waveの先頭からのバイト数, インデックス)のリストで、その位置まで再生したときに通知する
+	global _resampleState
+	if gen != generation:
+		# 合成中にstop()された音声は再生しない
+		_releaseRegion(region)
+		return
+	if timing is not None:
+		if timing["firstAudio"] is None:
+			timing["firstAudio"] = time.perf_counter() - timing["start"]
+		timing["bytes"] += len(wave)
+	if playerRate != samplingRate:
+		# 出力デバイスが要求したレートで開けなかったので、ここで変換する
+		length = len(wave)
+		wave, _resampleState = audioop.ratecv(bytes(wave), 2, 1, samplingRate, playerRate, _resampleState)
+		_releaseRegion(region)
+		region = None
+		marks = [(offset * len(wave) // length // 2 * 2, index) for offset, index in marks]
+	# 前の音声の再生中に次の音声を合成するため、ここではidle()しない
+	view = memoryview(wave)
+	start = 0
+	groups = []
+	for offset, index in marks:
+		if groups and offset <= groups[-1][0]:
+			# 同じ位置のインデックスは、音声を止めずにまとめて通知する
+			groups[-1][1].append(index)
+		else:
+			groups.append((offset, [index]))
+	for offset, indexes in groups:
+		if offset > start:
+			_feed(view[start:offset], onDone=lambda indexes=indexes: _fireIndexes(indexes, gen))
+			start = offset
+		else:
+			# 直前までに渡した音声の再生が終わったら通知する
+			for index in indexes:
+				_onIndex(index)
+	if start < len(view):
+		if region is not None:
+			_feed(view[start:], onDone=lambda: pcmRing.release(region))
+		else:
+			_feed(view[start:])
+	else:
+		_releaseRegion(region)
+
+
+def _fireIndexes(indexes, gen):
+	# playerから、その位置まで再生したときに呼ばれる
+	if gen != generation:
+		return
+	for index in indexes:
+		with tracer.span("index", index=index):
+			onIndexReached(index)
+
+
+def _releaseRegion(region):
+	if region is not None:
+		pcmRing.release(region)
+
+
+def _finishTiming(timing, gen):
+	# 再生スレッドで、1つの文章の最後の音声を渡した後に実行される
+	global lastTiming, _resampleState
+	_resampleState = None
+	if gen != generation or timing["firstAudio"] is None:
+		return
+	timing["total"] = time.perf_counter() - timing["start"]
+	lastTiming = timing
+	log.debug("VSU: %d chunks, first audio %.0f ms, total %.0f ms" % (timing["chunks"], timing["firstAudio"] * 1000, timing["total"] * 1000))
+	_recordQuality(timing)
+	stats.observe("firstAudioMs", timing["firstAudio"] * 1000)
+	stats.observe("utteranceMs", timing["total"] * 1000)
+	stats.observe("utteranceBytes", timing["bytes"])
+	stats.add("utterances")
+	stats.add("bytes", timing["bytes"])
+	_logStats()
+
+
+def _logStats():
+	global _statsLogged
+	interval = config.conf["VSU_synth"]["statsLogInterval"]
+	now = time.monotonic()
+	if not interval or now - _statsLogged < interval:
+		return
+	_statsLogged = now
+	log.info("VSU statistics:\n" + "\n".join(_vsuStats.formatSummary(getStats())))
+
+
+def _observeSynthesis(elapsed, length):
+	# 合成にかかった時間の、音声の長さに対する比を記録する
+	if length:
+		stats.observe("realTimeFactor", elapsed / (length / (samplingRate * 2)))
+
+
+def getStats():
+	"""Returns the performance statistics collected since the driver was loaded or resetStats() was called."""
+	ret = stats.getStats()
+	ret["caches"] = {
+		"wave": waveCache.getStats() if waveCache else None,
+		"disk": getDiskCacheStats(),
+		"query": queryCache.getStats() if queryCache else None,
+		"phrase": phraseCache.getStats() if phraseCache else None,
+		"charTable": getCharTableStats(),
+		"normalizer": normalizer.getStats(),
+	}
+	ret["engine"] = getEngineStats()
+	ret["quality"] = getQualityStats()
+	ret["trim"] = getTrimStats()
+	ret["buffer"] = pcmRing.getStats() if pcmRing else None
+	return ret
+
+
+def resetStats():
+	stats.clear()
+
+
+def getTrace():
+	"""Returns the recorded spans as Chrome trace-event JSON, or None when tracing is off."""
+	if not tracer.enabled:
+		return None
+	return tracer.export()
+
+
+def _recordQuality(timing):
+	quality = _qualityStats.setdefault(timing["samplingRate"], {"utterances": 0, "bytes": 0, "firstAudio": 0.0, "total": 0.0})
+	quality["utterances"] += 1
+	quality["bytes"] += timing["bytes"]
+	quality["firstAudio"] += timing["firstAudio"]
+	quality["total"] += timing["total"]
+	interval = config.conf["VSU_synth"]["qualityLogInterval"]
+	if interval and quality["utterances"] % interval == 0:
+		log.info("VSU: output quality statistics: %r" % getQualityStats())
+
+
+def getQualityStats():
+	"""Returns the measured transfer size and latency for each sampling rate used so far."""
+	ret = {}
+	for samplesPerSec, quality in sorted(_qualityStats.items()):
+		count = quality["utterances"]
+		ret[samplesPerSec] = {
+			"utterances": count,
+			# 合成の開始から受信し終わるまでの時間あたりに受け取った量
+			"bytesPerSecond": quality["bytes"] / quality["total"] if quality["total"] else 0.0,
+			"bytes": quality["bytes"],
+			"bytesPerUtterance": quality["bytes"] / count,
+			"firstAudio": quality["firstAudio"] / count,
+			"total": quality["total"] / count,
+		}
+	return ret
+
+
+def _feed(data, onDone=None):
+	# ディスクキャッシュのmemoryviewなどは、コピーせずにポインタで渡す
+	with tracer.span("player.feed", bytes=len(data)):
+		if isinstance(data, bytes):
+			player.feed(data, onDone=onDone)
+			return
+		data = memoryview(data)
+		if data.readonly and isinstance(data.obj, bytes) and data.nbytes == len(data.obj):
+			# 受信したブロック全体を指している
+			player.feed(data.obj, onDone=onDone)
+			return
+		try:
+			buf = (ctypes.c_char * data.nbytes).from_buffer(data)
+		except (TypeError, ValueError):
+			# 書き込めないバッファはポインタを取れないので、コピーして渡す
+			player.feed(bytes(data), onDone=onDone)
+			return
+		_fedBuffers.append(buf)
+		player.feed(ctypes.c_void_p(ctypes.addressof(buf)), size=data.nbytes, onDone=onDone)
+
+
+def _onIndex(index):
+	# 再生スレッドで実行される。それまでに渡した音声の再生が終わってから通知する
+	global isSpeaking
+	with tracer.span("player.idle"):
+		player.idle()
+	if index is None:
+		isSpeaking = False
+	with tracer.span("index", index=index):
+		onIndexReached(index)
+
 
 def _break(item):
-	sec = item.time / 1000
-	player.feed(b"\0" * int(SAMPLE_RATE * sec) * 2)  # 16bits, so multiply by 2
-	player.idle()
+	_playSilence(item.time / 1000, generation)
+
+
+def _playSilence(sec, gen):
+	# 共有の無音から切り出して渡す
+	silence = memoryview(SILENCE)
+	remaining = int(samplingRate * sec) * 2  # 16bits, so multiply by 2
+	while remaining > 0:
+		length = min(remaining, len(SILENCE))
+		_execWhenPlayed(_play, silence[:length], gen)
+		remaining -= length
 
 def speak(speechSequence):
 	global isSpeaking
-	for item in speechSequence:
-		if isinstance(item, str):
-			_execWhenDone(_speak, item, mustBeAsync=True)
-		elif isinstance(item, BreakCommand):
-			_execWhenDone(_break, item, mustBeAsync=True)
-		elif isinstance(item, IndexCommand):
-			_execWhenDone(onIndexReached, item.index)
-		elif isinstance(item, PitchCommand):
-			_execWhenDone(_setTemporaryPitch, item.newValue, mustBeAsync=True)
-		else:
-			pass
-		# end which speech command?
-	# end for each command in the sequence
-	# notify SynthDoneSpeaking
-	_execWhenDone(onIndexReached, None)
-	isSpeaking = False
+	with tracer.span("speak"):
+		if bgQueue is not None:
+			stats.observe("synthesisQueue", bgQueue.qsize())
+			stats.observe("playQueue", playQueue.qsize())
+		if joinIndexes:
+			speechSequence = _joinIndexedText(speechSequence)
+		for item in speechSequence:
+			if isinstance(item, str):
+				_execWhenDone(_speak, item, mustBeAsync=True)
+			elif isinstance(item, _JoinedText):
+				_execWhenDone(_speakJoined, item.pieces, mustBeAsync=True)
+			elif isinstance(item, BreakCommand):
+				_execWhenDone(_break, item, mustBeAsync=True)
+			elif isinstance(item, IndexCommand):
+				_execWhenDone(_execWhenPlayed, _onIndex, item.index)
+			elif isinstance(item, PitchCommand):
+				_execWhenDone(_setTemporaryPitch, item.newValue, mustBeAsync=True)
+			else:
+				pass
+			# end which speech command?
+		# end for each command in the sequence
+		# notify SynthDoneSpeaking
+		_execWhenDone(_execWhenPlayed, _onIndex, None)
+		isSpeaking = False
+		_checkUserDict()
 
 
 def stop():
-	global isSpeaking, bgQueue
-	params = []
-	try:
-		while True:
-			item = bgQueue.get_nowait()
-			if item[0] != _speak and item[0] != _break:
-				params.append(item)
-			bgQueue.task_done()
-	except queue.Empty:
-		pass
-	for item in params:
-		bgQueue.put(item)
-	isSpeaking = False
-	player.stop()
+	global isSpeaking, bgQueue, generation, _lastStop, _stopInterval
+	with tracer.span("stop"):
+		with _stopCondition:
+			generation += 1
+			now = time.monotonic()
+			_stopInterval = now - _lastStop
+			_lastStop = now
+			# 合成を待たせている文字列は、合成せずに捨てさせる
+			_stopCondition.notify_all()
+		# 合成中の文章があれば、応答を待たずに接続を切る
+		_abortRequests(bgThread)
+		removed = _flushQueue(bgQueue, (_speak, _speakJoined, _break))
+		# 合成する前に捨てた文字列の数
+		stats.add("flushed", len([item for item in removed if item[0] is not _break]))
+		_flushQueue(playQueue, (_play, _finishTiming))
+		isSpeaking = False
+		player.stop()
+		# 再生待ちだった音声の領域をまとめて解放する
+		pcmRing.clear()
 
 
 def pause(switch):
@@ -137,32 +830,368 @@ def pause(switch):
 
 
 def initialize(indexCallback=None):
-	global bgThread, bgQueue, player, onIndexReached
-	# 利用可能な音声を取得する、voicevoxの起動チェックも兼ねる
-	get_availableVoices(useCache = False)
-	player = nvwave.WavePlayer(
+	global bgThread, bgQueue, playThread, playQueue, player, onIndexReached, waveCache, queryCache, phraseCache, diskCache, healthProbe, endpointPool
+	global batchSize, warmThread, warmQueue, pcmRing, silenceThreshold, silenceGuard, normalizer
+	global userDictHash, _userDictMtime, joinIndexes, admissionWindow, charTableEnabled
+	global voices_cash
+	engineReady.clear()
+	_shuttingDown.clear()
+	_startSupervisor()
+	if supervisor:
+		endpointPool = _vsuEngine.EndpointPool([supervisor.endpoint])
+	else:
+		endpointPool = _vsuEngine.EndpointPool(config.conf["VSU_synth"]["endpoints"])
+	catalogue = _loadSpeakers()
+	if catalogue:
+		# 前回保存した話者の一覧ですぐに起動し、エンジンへの接続はバックグラウンドで待つ
+		voices_cash = catalogue
+	else:
+		try:
+			if supervisor:
+				supervisor.waitUntilReady(ENGINE_START_TIMEOUT)
+			# 利用可能な音声を取得する、voicevoxの起動チェックも兼ねる
+			get_availableVoices(useCache = False)
+		except Exception:
+			# 読み込みに失敗したときはterminate()が呼ばれないので、起動したエンジンをここで終了させる
+			_stopSupervisor()
+			raise
+	healthProbe = _vsuEngine.HealthProbe(endpointPool, _probe)
+	healthProbe.start()
+	diskCache = None
+	_openPlayer()
+	pcmRing = _vsuAudio.PcmRing(PCM_RING_SIZE)
+	onIndexReached = indexCallback
+	waveCache = _vsuCache.LRUCache(config.conf["VSU_synth"]["waveCacheSize"] * 1024 * 1024)
+	batchSize = config.conf["VSU_synth"]["batchSize"]
+	silenceThreshold = config.conf["VSU_synth"]["silenceThreshold"]
+	silenceGuard = config.conf["VSU_synth"]["silenceGuard"]
+	joinIndexes = config.conf["VSU_synth"]["joinIndexes"]
+	admissionWindow = config.conf["VSU_synth"]["admissionWindow"]
+	charTableEnabled = config.conf["VSU_synth"]["charTable"]
+	tracer.setSize(config.conf["VSU_synth"]["traceSize"])
+	normalizer = _vsuNormalizer.Normalizer(
+		PREPROCESS_RULES,
+		_loadReadings(),
+		nfkc=config.conf["VSU_synth"]["normalizeWidth"]
+	)
+	queryCache = _vsuCache.LRUCache(config.conf["VSU_synth"]["queryCacheSize"], sizeof=lambda query: 1)
+	phraseCache = _vsuCache.LRUCache(config.conf["VSU_synth"]["phraseCacheSize"], sizeof=lambda phrases: 1)
+	userDictHash = None
+	_userDictMtime = None
+	bgQueue = queue.Queue()
+	bgThread = BgThread(bgQueue, "SynthesisThread")
+	bgThread.start()
+	# エンジンの準備ができるまで、読み上げは合成待ちの列に溜めておく
+	bgQueue.put((_waitForEngine, (), {}))
+	if catalogue:
+		threading.Thread(target=_connectEngine, args=(catalogue,), name=f"{ __name__ }.StartupThread", daemon=True).start()
+	else:
+		_onEngineReady(None)
+	playQueue = queue.Queue(PLAY_QUEUE_SIZE)
+	playThread = BgThread(playQueue, "PlaybackThread")
+	playThread.start()
+	warmQueue = queue.Queue()
+	warmThread = BgThread(warmQueue, "WarmupThread")
+	warmThread.start()
+	warmQueue.put((_waitForEngine, (), {}))
+	# 最近使った話者を、最初の読み上げより前に読み込ませておく
+	_scheduleWarmUp(config.conf["VSU_synth"]["recentStyles"])
+	# 話者の読み込みが済んでから、入力した文字の読み上げ用の音声を作る
+	_scheduleCharTable()
+
+
+def _startSupervisor():
+	global supervisor
+	command = config.conf["VSU_synth"]["engineCommand"]
+	if not command:
+		return
+	supervisor = _vsuSupervisor.EngineSupervisor(
+		command,
+		config.conf["VSU_synth"]["engineArgs"].split(),
+		threads=config.conf["VSU_synth"]["engineThreads"],
+		memoryLimit=config.conf["VSU_synth"]["engineMemoryLimit"] * 1024 * 1024,
+		onRestart=_onEngineRestart,
+		isBusy=lambda: isSpeaking,
+		logFile=_vsuPath(ENGINE_LOG_FILE)
+	)
+	supervisor.start()
+
+
+def _stopSupervisor():
+	global supervisor
+	if supervisor:
+		supervisor.stop()
+		supervisor = None
+
+
+def _onEngineRestart():
+	# 再起動したエンジンでは、話者を読み込み直す必要がある
+	_scheduleWarmUp(config.conf["VSU_synth"]["recentStyles"])
+
+
+def calibrateEngine():
+	"""Measures the managed engine with several numbers of CPU threads and restarts it with the fastest.
+
+	The chosen number is saved as engineThreads. Returns (threads, results) as _vsuSupervisor.calibrate() does.
+	This takes minutes, so call it from a background thread.
+	"""
+	if supervisor is None:
+		raise Exception("the engine is not started by VSU.")
+	current = supervisor
+	threads, results = _vsuSupervisor.calibrate(current.command, current.args, speaker=voice, stopEvent=_shuttingDown)
+	if _shuttingDown.is_set():
+		raise Exception("the driver was terminated.")
+	config.conf["VSU_synth"]["engineThreads"] = threads
+	current.restart(threads)
+	return threads, results
+
+
+def isEngineManaged():
+	return supervisor is not None
+
+
+def _waitForEngine():
+	# 合成スレッドと待機スレッドで最初に実行され、エンジンの準備ができるまで後の処理を待たせる
+	while not engineReady.wait(0.5):
+		if _shuttingDown.is_set():
+			return
+
+
+def _connectEngine(catalogue):
+	# 保存しておいた話者の一覧で起動したときに、別のスレッドでエンジンに接続できるまで試みる
+	delay = 0.5
+	while not _shuttingDown.is_set():
+		try:
+			get_availableVoices(useCache=False, request=getSession().get)
+		except Exception:
+			log.debug("VSU: engine is not ready yet", exc_info=True)
+			_shuttingDown.wait(delay)
+			delay = min(delay * 2, CONNECT_RETRY_MAX)
+			continue
+		_onEngineReady(catalogue)
+		return
+
+
+def _onEngineReady(catalogue):
+	# 話者の一覧を取得できた後、合成を始める前に済ませておく処理
+	global diskCache
+	voices = get_availableVoices()
+	saved = [[id, info.displayName] for id, info in voices.items()]
+	if catalogue is None or saved != [[id, info.displayName] for id, info in catalogue.items()]:
+		if catalogue is not None:
+			log.info("VSU: the speakers of the engine have changed since they were saved")
+		_saveSpeakers(saved)
+	if catalogue is not None and voice not in voices:
+		log.warning(f"VSU: speaker { voice } is not provided by the engine")
+	diskCache = _openDiskCache()
+	# 辞書の内容が前回送ったものと同じなら、エンジンには何も送らない
+	_syncUserDict()
+	engineReady.set()
+
+
+def _loadSpeakers():
+	# 前回保存した話者の一覧を読み込む。なければNoneを返す
+	try:
+		with open(_vsuPath(SPEAKERS_FILE), "r", encoding="utf-8") as f:
+			return OrderedDict((id, VoiceInfo(id, name, "ja")) for id, name in json.load(f))
+	except (OSError, ValueError, TypeError):
+		return None
+
+
+def _saveSpeakers(speakers):
+	path = _vsuPath(SPEAKERS_FILE)
+	try:
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		with open(path + ".tmp", "w", encoding="utf-8") as f:
+			json.dump(speakers, f, ensure_ascii=False)
+		os.replace(path + ".tmp", path)
+	except OSError:
+		log.debug("VSU: failed to save the speakers", exc_info=True)
+
+
+def _openDiskCache():
+	diskCacheSize = config.conf["VSU_synth"]["diskCacheSize"]
+	if diskCacheSize <= 0:
+		return None
+	try:
+		return _vsuDiskCache.DiskCache(
+			os.path.join(globalVars.appArgs.configPath, "VSU", "cache"),
+			diskCacheSize * 1024 * 1024,
+			_getEngineSignature()
+		)
+	except Exception:
+		log.error("Failed to open the disk cache", exc_info=True)
+		return None
+
+
+def _vsuPath(name):
+	return os.path.join(globalVars.appArgs.configPath, "VSU", name)
+
+
+def _checkUserDict():
+	# ユーザー辞書が編集されていれば、バックグラウンドで送り直す
+	global _userDictChecked
+	now = time.monotonic()
+	if warmQueue is None or now - _userDictChecked < USER_DICT_CHECK_INTERVAL:
+		return
+	_userDictChecked = now
+	warmQueue.put((_syncUserDict, (), {}))
+
+
+def _syncUserDict():
+	"""Pushes the user dictionary file to every engine that does not have its current content."""
+	global userDictHash, _userDictMtime
+	path = _vsuPath(USER_DICT_FILE)
+	try:
+		mtime = os.path.getmtime(path)
+	except OSError:
+		mtime = None
+	if userDictHash is not None and mtime == _userDictMtime:
+		return
+	try:
+		words = _vsuUserDict.loadWords(path) if mtime is not None else OrderedDict()
+	except Exception:
+		log.error("Failed to load the user dictionary", exc_info=True)
+		return
+	contentHash = _vsuUserDict.contentHash(words)
+	statePath = _vsuPath(USER_DICT_STATE_FILE)
+	state = _vsuUserDict.loadState(statePath)
+	synced = True
+	for ep in list(endpointPool.endpoints.values()):
+		key = _userDictKey(ep)
+		pushed = state.get(key)
+		if pushed is not None and pushed["hash"] == contentHash:
+			continue
+		try:
+			_pushUserDict(ep, words, pushed["words"] if pushed is not None else None)
+		except Exception:
+			log.error(f"Failed to update the user dictionary of { ep.name }", exc_info=True)
+			synced = False
+			continue
+		state[key] = {"hash": contentHash, "words": words}
+		try:
+			os.makedirs(os.path.dirname(statePath), exist_ok=True)
+			_vsuUserDict.saveState(statePath, state)
+		except OSError:
+			log.debug("VSU: failed to save the user dictionary state", exc_info=True)
+	if synced:
+		# 送れなかったエンジンがあれば、次の確認で送り直す
+		_userDictMtime = mtime
+	if userDictHash is not None and contentHash != userDictHash:
+		# 読み方が変わるので、解析結果と音声を作り直す
+		for cache in (queryCache, phraseCache, waveCache):
+			if cache is not None:
+				cache.clear()
+		charTable.clear()
+		_scheduleCharTable()
+	userDictHash = contentHash
+
+
+def _userDictKey(ep):
+	# 管理するエンジンは起動するたびにポートが変わるので、アドレスではなく実行ファイルで区別する
+	if supervisor is not None and ep.name == supervisor.endpoint:
+		return "command:" + os.path.normcase(os.path.abspath(supervisor.command))
+	return ep.name
+
+
+def _pushUserDict(ep, words, pushed):
+	if pushed is None:
+		# 初めて送るエンジンには、まとめて登録する
+		changed, removed = words, []
+	else:
+		# 前回送った内容との差分だけを送る
+		changed, removed = _vsuUserDict.diff(pushed, words)
+	if changed:
+		r = _request("post", "import_user_dict", endpoint=ep, params={"override": "true"},
+			json=_vsuUserDict.toImport(changed), timeout=(10.0, 300.0))
+		if r.status_code not in (200, 204):
+			raise Exception(f"import_user_dict failed: { r.text }")
+	for surface in removed:
+		r = _request("delete", "user_dict_word/" + _vsuUserDict.wordId(surface), endpoint=ep, timeout=(10.0, 30.0))
+		if r.status_code not in (200, 204, 404, 422):
+			raise Exception(f"user_dict_word failed: { r.text }")
+	log.debug(f"VSU: registered { len(changed) } words and removed { len(removed) } words on { ep.name }")
+
+
+def _loadReadings():
+	path = _vsuPath(READINGS_FILE)
+	if not os.path.isfile(path):
+		return None
+	try:
+		readings = _vsuNormalizer.loadReadings(path)
+	except Exception:
+		log.error("Failed to load the reading dictionary", exc_info=True)
+		return None
+	log.debug("VSU: loaded %d readings" % len(readings))
+	return readings
+
+
+def _openPlayer():
+	global player, playerRate, _resampleState
+	_resampleState = None
+	try:
+		player = _createPlayer(samplingRate)
+		playerRate = samplingRate
+	except Exception:
+		# 出力デバイスが対応していないレートは、再生時に変換する
+		log.warning("VSU: could not open the output device at %d Hz, resampling to %d Hz" % (samplingRate, SAMPLE_RATE), exc_info=True)
+		player = _createPlayer(SAMPLE_RATE)
+		playerRate = SAMPLE_RATE
+
+
+def _createPlayer(samplesPerSec):
+	return nvwave.WavePlayer(
 		channels=1,
-		samplesPerSec=SAMPLE_RATE,
+		samplesPerSec=samplesPerSec,
 		bitsPerSample=16,
 		outputDevice=config.conf["speech"]["outputDevice"],
 		buffered=False
 	)
-	onIndexReached = indexCallback
-	bgQueue = queue.Queue()
-	bgThread = BgThread()
-	bgThread.start()
+
+
+def _reopenPlayer():
+	# 再生スレッドで実行される
+	if playerRate == samplingRate:
+		return
+	player.close()
+	_openPlayer()
 
 
 def terminate():
-	global bgThread, bgQueue, player, onIndexReached
+	global bgThread, bgQueue, playThread, playQueue, player, onIndexReached, diskCache, healthProbe, warmThread, warmQueue
+	global _charTableScheduled
+	# エンジンの準備を待っている処理をやめさせる
+	_shuttingDown.set()
 	stop()
+	# 話者の読み込みには時間がかかることがあるので、終了を待たない
+	_flushQueue(warmQueue, (_warmUp, _buildCharTable, _syncUserDict))
+	_charTableScheduled = False
+	warmQueue.put((None, None, None))
+	warmThread = None
+	warmQueue = None
 	bgQueue.put((None, None, None))
 	bgThread.join()
 	bgThread = None
 	bgQueue = None
+	playQueue.put((None, None, None))
+	playThread.join()
+	playThread = None
+	playQueue = None
 	player.close()
 	player = None
 	onIndexReached = None
+	_fedBuffers.clear()
+	pcmRing.clear()
+	waveCache.clear()
+	charTable.clear()
+	queryCache.clear()
+	phraseCache.clear()
+	if diskCache:
+		diskCache.close()
+		diskCache = None
+	healthProbe.stop()
+	healthProbe = None
+	_stopSupervisor()
 
 
 def _fixBoundary(val):
@@ -178,6 +1207,7 @@ def setRate(newrate):
 		newrate = 1
 	global rate
 	rate = newrate
+	_scheduleCharTable()
 
 
 def getRate():
@@ -190,6 +1220,7 @@ def setPitch(newpitch):
 		newpitch = 1
 	pitch = newpitch
 	temporaryPitch = newpitch
+	_scheduleCharTable()
 
 
 def getPitch():
@@ -208,6 +1239,7 @@ def setInflection(newinflection):
 		newinflection = 1
 	global inflection
 	inflection = newinflection
+	_scheduleCharTable()
 
 
 def getInflection():
@@ -217,6 +1249,7 @@ def getInflection():
 def setVolume(newvolume):
 	global volume
 	volume = newvolume
+	_scheduleCharTable()
 
 
 def getVolume():
@@ -226,79 +1259,665 @@ def getVolume():
 def setVoice(newvoice):
 	global voice
 	voice = newvoice
+	_rememberStyle(newvoice)
+	_scheduleCharTable()
+
+
+def _rememberStyle(style):
+	# 最近使った話者を、新しい順にwarmupStyles個まで覚えておく
+	recent = [style] + [s for s in config.conf["VSU_synth"]["recentStyles"] if s != style]
+	recent = recent[:config.conf["VSU_synth"]["warmupStyles"]]
+	if recent != list(config.conf["VSU_synth"]["recentStyles"]):
+		config.conf["VSU_synth"]["recentStyles"] = recent
+	if style in recent:
+		_scheduleWarmUp([style])
+
+
+def _scheduleWarmUp(styles):
+	if warmQueue is None:
+		return
+	for style in styles:
+		warmQueue.put((_warmUp, (style,), {}))
+
+
+def _warmUp(style):
+	# 話者のモデルは最初の合成時に読み込まれるので、事前に読み込ませて短い文を合成しておく
+	for ep in list(endpointPool.endpoints.values()):
+		if ep.breaker.isOpen() or not ep.supports(style):
+			continue
+		try:
+			r = _request("get", "is_initialized_speaker", endpoint=ep, params={"speaker": style}, timeout=(10.0, 30.0))
+			if r.status_code == 200 and r.json() is True:
+				continue
+			_request("post", "initialize_speaker", endpoint=ep, params={"speaker": style, "skip_reinit": "true"},
+				timeout=(10.0, 300.0))
+			r = _request("post", "audio_query", endpoint=ep, params={"text": WARMUP_TEXT, "speaker": style},
+				timeout=(10.0, 300.0))
+			if r.status_code == 200:
+				# 読み上げと同じ経路で合成する。中断できる合成では、合成用の子プロセスがそれぞれモデルを読み込み、
+				# 順番に使われるので、その数だけ合成しておく
+				query = _applyProsody(r.json())
+				for i in range(CANCELLABLE_WORKERS):
+					_synthesize(None, query=query, speaker=style, endpoint=ep, observe=False).close()
+					if not cancellableSynthesis:
+						break
+			log.debug(f"VSU: speaker { style } warmed up on { ep.name }")
+		except Exception:
+			log.debug(f"VSU: failed to warm up speaker { style } on { ep.name }", exc_info=True)
+
+
+def _scheduleCharTable():
+	global _charTableScheduled
+	# 設定の変更が続いても、作り直しは1回だけ予約する
+	if warmQueue is None or not charTableEnabled or _charTableScheduled:
+		return
+	_charTableScheduled = True
+	warmQueue.put((_buildCharTable, (), {}))
+
+
+def _charTableSource(text):
+	# カタカナ1文字はひらがなと同じ音声になるので、ひらがなの分を合成して使い回す
+	# 読みの辞書で書き換えられて、1文字でなくなっている場合もある
+	if len(text) == 1 and 0x30a1 <= ord(text) <= 0x30f6:
+		return chr(ord(text) - 0x60)
+	return text
+
+
+def _buildCharTable():
+	# 待機スレッドで実行される。現在の話者と設定で、1文字の音声の表を作る
+	global _charTableScheduled
+	_charTableScheduled = False
+	# 大文字の読み上げなどで一時的に変わった高さは、読み上げが終われば戻るので、設定はその後で読む
+	_waitUntilIdle()
+	if warmQueue is None:
+		return
+	settings = _cacheKey("")[1:]
+	# 前の設定の音声。文字から(設定, 音声)への辞書
+	old = {}
+	for key in list(charTable):
+		if key[1:] != settings:
+			old[key[0]] = (key[1:], charTable.pop(key))
+	# 同じ音声を使い回している文字は、変換後も使い回す
+	scaled = {}
+	pending = OrderedDict()
+	for ch in CHAR_TABLE_TEXTS:
+		text = _preprocess(ch)
+		if not text or (text,) + settings in charTable:
+			continue
+		if text in old:
+			oldSettings, wave = old[text]
+			if id(wave) not in scaled:
+				scaled[id(wave)] = _scaleCharWave(wave, oldSettings, settings)
+			if scaled[id(wave)] is not None:
+				charTable[(text,) + settings] = scaled[id(wave)]
+				continue
+		pending.setdefault(_charTableSource(text), []).append(text)
+	sources = list(pending)
+	for i in range(0, len(sources), CHAR_TABLE_BATCH):
+		_waitUntilIdle()
+		if warmQueue is None:
+			return
+		if _cacheKey("")[1:] != settings:
+			# 設定が変わった。一時的な高さの変更では作り直しが予約されないので、ここで予約する
+			_scheduleCharTable()
+			return
+		batch = sources[i:i + CHAR_TABLE_BATCH]
+		try:
+			try:
+				waves = getMultiWave(batch)
+			except Exception:
+				waves = [getWave(text) for text in batch]
+		except Exception:
+			log.debug("VSU: failed to build the character table", exc_info=True)
+			return
+		if _cacheKey("")[1:] != settings:
+			_scheduleCharTable()
+			return
+		for source, wave in zip(batch, waves):
+			for text in pending[source]:
+				charTable[(text,) + settings] = wave
+	log.debug("VSU: character table has %d entries" % len(charTable))
+
+
+def _waitUntilIdle():
+	# 読み上げ中は、エンジンを読み上げに使わせる
+	while bgQueue is not None and bgQueue.unfinished_tasks:
+		time.sleep(0.1)
+
+
+def _scaleCharWave(wave, oldSettings, settings):
+	# 音量だけが変わった場合は、合成し直さずに前の音声の振幅を変える。それ以外はNoneを返す
+	# 設定は(話者, 話速, 高さ, 抑揚, 音量, サンプリングレート)
+	if not oldSettings[4] or oldSettings[:4] + oldSettings[5:] != settings[:4] + settings[5:]:
+		return None
+	return bytearray(audioop.mul(bytes(wave), 2, settings[4] / oldSettings[4]))
+
+
+def getCharTableStats():
+	lookups = _charTableStats["hits"] + _charTableStats["misses"]
+	return {
+		"entries": len(charTable),
+		# カタカナとひらがなで共有している音声は1回だけ数える
+		"size": sum(len(wave) for wave in {id(wave): wave for wave in list(charTable.values())}.values()),
+		"hits": _charTableStats["hits"],
+		"misses": _charTableStats["misses"],
+		"hitRate": _charTableStats["hits"] / lookups if lookups else 0.0,
+	}
 
 
 def getVoice():
 	return voice
 
 
-def getWave(text, port = 50021):
+def setStreaming(newstreaming):
+	global streaming
+	streaming = newstreaming
+
+
+def getStreaming():
+	return streaming
+
+
+def setQuality(newQuality):
+	global samplingRate
+	newRate = int(newQuality)
+	if newRate == samplingRate:
+		return
+	# 変更前のレートで合成した音声を再生しないよう、読み上げを止めてからplayerを開き直す
+	if player:
+		stop()
+	samplingRate = newRate
+	if player:
+		_execWhenDone(_execWhenPlayed, _reopenPlayer)
+	_scheduleCharTable()
+
+
+def getQuality():
+	return str(samplingRate)
+
+
+def getLastTiming():
+	return lastTiming
+
+
+def _cacheKey(text):
+	return (" ".join(text.split()), voice, rate, temporaryPitch, inflection, volume, samplingRate)
+
+
+def getCachedWave(text):
+	# 同じ文字列・設定の音声はエンジンに問い合わせずに再利用する
+	key = _cacheKey(text)
+
+	def create():
+		wave = _diskLookup(key)
+		if wave is None:
+			wave = getWave(text)
+			_diskStore(key, wave)
+		return wave
+	return waveCache.get(key, create)
+
+
+def _diskKey(key):
+	return _vsuDiskCache.makeKey(*key, silenceThreshold, silenceGuard, userDictHash)
+
+
+def _findWave(key):
+	# 合成済みの音声を、1文字の音声の表、メモリ、ディスクの順に探す
+	wave = charTable.get(key)
+	if wave is not None:
+		_charTableStats["hits"] += 1
+		return wave
+	if len(key[0]) == 1:
+		_charTableStats["misses"] += 1
+	wave = waveCache.peek(key)
+	if wave is None:
+		wave = _diskLookup(key)
+	return wave
+
+
+def _diskLookup(key):
+	if not diskCache:
+		return None
+	return diskCache.get(_diskKey(key))
+
+
+def _diskStore(key, wave):
+	if diskCache:
+		diskCache.put(_diskKey(key), wave)
+
+
+def _storeWave(key, wave):
+	waveCache.put(key, wave)
+	_diskStore(key, wave)
+
+
+def iterWave(text, query=None, key=None):
+	"""Yields the PCM of text block by block as it is received from the engine.
+
+	Each item is a (wave, region) pair. Received audio is read into pcmRing, and region must be released
+	once the player is done with wave; it is None for cached audio, which is yielded at once.
+	Received audio is cached unless it is longer than MAX_CACHED_WAVE, so memory held per utterance stays bounded.
+	When query is given, it is synthesized as is and cached under key. Its silence is not trimmed,
+	so that positions computed from the query stay valid.
+	"""
+	if key is None:
+		key = _cacheKey(text)
+	wave = _findWave(key)
+	if wave is not None:
+		yield wave, None
+		return
+	start = time.perf_counter()
+	r = _synthesize(text, stream=True, query=query)
+	# 受信中は再生を待つことがあるので、応答が返るまでを合成の時間とする
+	elapsed = time.perf_counter() - start
+	reader = _vsuAudio.RiffReader()
+	received = 0
+	trimmer = None
+	if silenceThreshold and query is None:
+		trimmer = _vsuAudio.SilenceTrimmer(silenceThreshold, *_trimWindow())
+	collected = bytearray()
+	region = None
+	# 受信済みで、まだ渡していない音声
+	pending = deque()
+	try:
+		done = False
+		while not done:
+			reserved = pcmRing.reserve(STREAM_BLOCK_SIZE)
+			if reserved is None:
+				# 再生が追いついておらず空きがない
+				block = r.raw.read(STREAM_BLOCK_SIZE)
+			else:
+				region, view = reserved
+				length = r.raw.readinto(view)
+				pcmRing.commit(region, length)
+				block = view[:length]
+			if not len(block):
+				done = True
+				_releaseRegion(region)
+				if trimmer:
+					pending.extend(trimmer.finish())
+			else:
+				parts = reader.feed(block)
+				received += sum(len(part) for part in parts)
+				# 領域は、その領域から切り出した最後の音声の再生が終わったら解放する
+				items = [(part, None) for part in parts[:-1]] + [(part, region) for part in parts[-1:]]
+				if not parts:
+					_releaseRegion(region)
+				if trimmer:
+					items = [item for pair in items for item in trimmer.feed(*pair)]
+				pending.extend(items)
+			region = None
+			while pending:
+				part, partRegion = pending.popleft()
+				if not len(part):
+					_releaseRegion(partRegion)
+					continue
+				if collected is not None:
+					if len(collected) + len(part) > MAX_CACHED_WAVE:
+						collected = None
+					else:
+						collected += part
+				yield part, partRegion
+	except Exception:
+		# stop()で切断された
+		_checkCancelled()
+		raise
+	finally:
+		if trimmer:
+			pending.extend(trimmer.finish())
+		for part, partRegion in pending:
+			_releaseRegion(partRegion)
+		_releaseRegion(region)
+		r.close()
+	_observeSynthesis(elapsed, received)
+	if trimmer:
+		_recordTrim(trimmer.trimmed)
+	if collected:
+		_storeWave(key, collected)
+
+
+def _trimWindow():
+	# 無音を探す単位(5ms)と、音の前後に残す長さをバイト数で返す
+	bytesPerSec = samplingRate * 2
+	return max(2, bytesPerSec // 200 // 2 * 2), bytesPerSec * silenceGuard // 1000 // 2 * 2
+
+
+def _trimWave(wave):
+	if not silenceThreshold:
+		return wave
+	wave, removed = _vsuAudio.trimSilence(wave, silenceThreshold, *_trimWindow())
+	_recordTrim(removed)
+	return wave
+
+
+def _recordTrim(removed):
+	ms = removed * 1000 / (samplingRate * 2)
+	_trimStats["waves"] += 1
+	_trimStats["trimmedMs"] += ms
+	log.debug("VSU: trimmed %.0f ms of silence" % ms)
+
+
+def getTrimStats():
+	waves = _trimStats["waves"]
+	return {
+		"waves": waves,
+		"trimmedMs": _trimStats["trimmedMs"],
+		"meanTrimmedMs": _trimStats["trimmedMs"] / waves if waves else 0.0,
+	}
+
+
+def getCacheStats():
+	return waveCache.getStats()
+
+
+def getBufferStats():
+	return pcmRing.getStats()
+
+
+def getDiskCacheStats():
+	if not diskCache:
+		return None
+	return diskCache.getStats()
+
+
+def _getEngineSignature():
+	# エンジンのバージョンか話者の構成が変わったら、ディスクキャッシュを作り直す
+	r = _request("get", "version", timeout=(10.0, 30.0))
+	r.raise_for_status()
+	speakers = ",".join(f"{ id }:{ info.displayName }" for id, info in get_availableVoices().items())
+	return r.json() + "/" + _vsuDiskCache.makeKey(speakers)
+
+
+def getAudioQuery(text):
+	# audio_queryの結果は話速などの設定によらないので、文字列と話者だけで再利用する
+	if phraseCache.maxSize > 0:
+		return queryCache.get((" ".join(text.split()), voice), lambda: _buildAudioQuery(text))
+	return queryCache.get((" ".join(text.split()), voice), lambda: _audioQuery(text))
+
+
+def getNormalizerStats():
+	return normalizer.getStats()
+
+
+def getQueryCacheStats():
+	return queryCache.getStats()
+
+
+def getPhraseCacheStats():
+	return phraseCache.getStats()
+
+
+def _buildAudioQuery(text):
+	# 断片ごとのアクセント句をつなげてaudio_queryを組み立てる。エンジンには未知の断片だけを送る
+	segments = _vsuText.splitSegments(text)
+	if len(segments) > 1 and not any(_phraseKey(segment) in phraseCache for segment in segments):
+		# 再利用できる断片がなければ、断片ごとに問い合わせるより、文字列全体を1回で解析する方が速い
+		return _audioQuery(text)
+	query_data = dict(QUERY_TEMPLATE)
+	query_data["accent_phrases"] = _segmentPhrases(segments)
+	return query_data
+
+
+def _segmentPhrases(segments):
+	# 断片ごとのアクセント句をつなげる
+	phrases = []
+	for i, segment in enumerate(segments):
+		segmentPhrases = getAccentPhrases(segment)
+		if i + 1 < len(segments):
+			# 断片の末尾の句読点には、エンジンが無音を入れていない
+			segmentPhrases = _vsuText.withBoundaryPause(segmentPhrases, segment)
+		phrases.extend(segmentPhrases)
+	return phrases
+
+
+def getAccentPhrases(text):
+	return phraseCache.get(_phraseKey(text), lambda: _accentPhrases(text))
+
+
+def _phraseKey(text):
+	return (" ".join(text.split()), voice)
+
+
+def _accentPhrases(text):
+	payload = {"text": text, "speaker": voice}
+	start = time.perf_counter()
+	r = _request("post", "accent_phrases", speaker=voice, params=payload, timeout=(10.0, 3000.0))
+	stats.observe("audioQueryMs", (time.perf_counter() - start) * 1000)
+	if r.status_code != 200:
+		raise Exception("Make accent phrases faild.")
+	return r.json()
+
+
+def _audioQuery(text):
 	global voice
+
+	# connect timeoutは10秒、read timeoutは3000秒に設定（長文対応）
+	query_payload = {"text": text, "speaker": voice}
+	start = time.perf_counter()
+	r = _request("post", "audio_query", speaker=voice, params=query_payload, timeout=(10.0, 3000.0))
+	stats.observe("audioQueryMs", (time.perf_counter() - start) * 1000)
+	if r.status_code != 200:
+		raise Exception("Make audio query faild.")
+	return r.json()
+
+
+def _prepareQuery(text):
+	# audio_query
+	# キャッシュされたものを書き換えないよう、コピーしてから話速などを設定する
+	return _applyProsody(dict(getAudioQuery(text)))
+
+
+def _applyProsody(query_data):
 	global rate
 	global temporaryPitch
 	global inflection
 	global volume
 
-	# Internal Server Error(500)が出ることがあるのでリトライする
-	# （HTTPAdapterのretryはうまくいかなかったので独自実装）
-	# connect timeoutは10秒、read timeoutは3000秒に設定（長文対応）
-	# audio_query
-	query_payload = {"text": text, "speaker": voice}
-	for query_i in range(10):
-		r = getSession().post(f"http://localhost:{ port }/audio_query", 
-			params=query_payload, timeout=(10.0, 3000.0))
-		if r.status_code == 200:
-			query_data = r.json()
-			break
-		time.sleep(0.1)
-	else:
-		raise exception("Make audio query faild.")
-
-	# synthesis
-	synth_payload = {"speaker": voice}
 	query_data["speedScale"]=(rate+20) / 50
 	query_data["pitchScale"]=(temporaryPitch - 50)*0.0015
 	query_data["intonationScale"]=inflection / 50
 	query_data["volumeScale"]=volume / 50
 	query_data["prePhonemeLength"]=0
 	query_data["postPhonemeLength"]=0
+	query_data["outputSamplingRate"] = samplingRate
+	query_data["outputStereo"] = False
+	return query_data
 
-	for synth_i in range(10):
-		r = getSession().post(f"http://localhost:{ port }/synthesis", params=synth_payload, 
-			data=json.dumps(query_data), timeout=(1000.0, 30000.0))
-		if r.status_code == 200:
-			# wavファイルヘッダ44バイトは切ってから返す
-			return r.content[44:]
-		time.sleep(0.1)
-	else:
-		raise exception("speak failed.")
 
+def getWave(text):
+	start = time.perf_counter()
+	r = _synthesize(text)
+	wave, reader = _vsuAudio.parseWave(r.content)
+	_observeSynthesis(time.perf_counter() - start, len(wave))
+	# 書き込めるバッファにしておくと、再生時にコピーせずに渡せる
+	return bytearray(_trimWave(wave))
+
+
+def _synthesize(text, stream=False, query=None, speaker=None, endpoint=None, observe=True):
+	query_data = query if query is not None else _prepareQuery(text)
+	speaker = speaker or voice
+
+	# synthesis
+	# 中断できる合成では、接続を切るとエンジン側の合成も止まる
+	global cancellableSynthesis
+	synth_payload = {"speaker": speaker}
+	start = time.perf_counter()
+	if cancellableSynthesis:
+		r = _request("post", "cancellable_synthesis", endpoint=endpoint, speaker=speaker, params=synth_payload,
+			data=json.dumps(query_data), timeout=(1000.0, 30000.0), stream=stream)
+		if r.status_code == 404:
+			# --enable_cancellable_synthesisなしで起動されている
+			r.close()
+			cancellableSynthesis = False
+	if not cancellableSynthesis:
+		r = _request("post", "synthesis", endpoint=endpoint, speaker=speaker, params=synth_payload,
+			data=json.dumps(query_data), timeout=(1000.0, 30000.0), stream=stream)
+	if r.status_code != 200:
+		r.close()
+		raise Exception("speak failed.")
+	# ストリーミングでも、エンジンは合成を終えてから応答する
+	if observe:
+		stats.observe("synthesisMs", (time.perf_counter() - start) * 1000)
+	return r
 
-def get_availableVoices(port = 50021, useCache = True):
+
+def getMultiWave(texts):
+	# 複数の文字列を1回のリクエストで合成する。結果はWAVファイルをまとめたZIPで返される
+	queries = [_prepareQuery(text) for text in texts]
+	synth_payload = {"speaker": voice}
+	start = time.perf_counter()
+	r = _request("post", "multi_synthesis", speaker=voice, params=synth_payload,
+		data=json.dumps(queries), timeout=(1000.0, 30000.0))
+	if r.status_code == 404:
+		raise Exception("multi synthesis is not supported.")
+	if r.status_code != 200:
+		raise Exception("multi synthesis failed.")
+	stats.observe("synthesisMs", (time.perf_counter() - start) * 1000)
+	with zipfile.ZipFile(io.BytesIO(r.content)) as z:
+		# 入力の順番に連番のファイル名が付けられている
+		waves = [_vsuAudio.parseWave(z.read(name))[0] for name in sorted(z.namelist())]
+	_observeSynthesis(time.perf_counter() - start, sum(len(wave) for wave in waves))
+	return [bytearray(_trimWave(wave)) for wave in waves]
+
+
+def get_availableVoices(useCache = True, request=None):
 	global voices_cash
 	if useCache and voices_cash:
 		return voices_cash
 
-	for synth_i in range(10):
-		r = getSession().get(f"http://localhost:{ port }/speakers", timeout=(100, 300))
-		if r.status_code == 200:
-			lst = r.json()
-			break
-		time.sleep(0.1)
-	else:
-		raise Exception("get voice list failed.")
-
+	# エンジンごとに話者を確認し、いずれかのエンジンで使える話者を一覧にする
 	ret = OrderedDict()
-	for speaker in lst:
-		for style in speaker["styles"]:
-			ret[str(style["id"])] = VoiceInfo(str(style["id"]), speaker["name"] + "(" + style["name"] + ")", "ja")
+	error = None
+	for ep in list(endpointPool.endpoints.values()):
+		try:
+			lst = _getSpeakers(ep, request)
+		except Exception as e:
+			log.debug(f"VSU: failed to get speakers from { ep.name }", exc_info=True)
+			error = e
+			continue
+		for speaker in lst:
+			for style in speaker["styles"]:
+				ret[str(style["id"])] = VoiceInfo(str(style["id"]), speaker["name"] + "(" + style["name"] + ")", "ja")
+	if not ret:
+		raise error or Exception("get voice list failed.")
 	voices_cash = ret
 	return ret
 
 
+def _getSpeakers(ep, request=None):
+	if request is None:
+		r = _request("get", "speakers", endpoint=ep, timeout=(100, 300))
+	else:
+		r = request(f"http://{ ep.name }/speakers", timeout=(1.0, 30.0))
+	if r.status_code != 200:
+		raise Exception("get voice list failed.")
+	lst = r.json()
+	ep.speakers = set(str(style["id"]) for speaker in lst for style in speaker["styles"])
+	return lst
+
+
 def getSession():
 	global session
 	if session:
 		return session
 	session = requests.Session()
+	session.mount("http://", _CancellableAdapter())
 	return session
+
+
+def _checkCancelled():
+	if threading.current_thread() is bgThread and _synthGeneration != generation:
+		raise SynthesisCancelled()
+
+
+def _request(method, path, endpoint=None, speaker=None, **kwargs):
+	# Internal Server Error(500)が出ることがあるのでリトライする
+	# （HTTPAdapterのretryはうまくいかなかったので独自実装）
+	# endpointを指定しなければ、speakerを使えるエンジンのうち最も空いているものに送る
+	# 失敗が続いているエンジンは、回復するまで振り分け先から外す
+	failed = set()
+	error = None
+	for attempt in range(retryPolicy.attempts):
+		ep = endpoint or endpointPool.choose(speaker, failed)
+		if ep is None:
+			raise _vsuEngine.EngineUnavailable(f"no engine provides speaker { speaker }.")
+		if not ep.breaker.allow():
+			raise _vsuEngine.EngineUnavailable(f"engine { ep.name } is not available.")
+		if attempt:
+			retryPolicy.retries += 1
+		# 合成スレッドでstop()後に送ろうとしたリクエストや、stop()で切断されたリクエストは中断として扱う
+		_checkCancelled()
+		endpointPool.begin(ep)
+		start = time.perf_counter()
+		try:
+			with tracer.span("/" + path, endpoint=ep.name, attempt=attempt):
+				r = getSession().request(method, f"http://{ ep.name }/{ path }", **kwargs)
+		except requests.RequestException as e:
+			_checkCancelled()
+			ep.breaker.recordFailure()
+			error = e
+		else:
+			if r.status_code < 500:
+				ep.breaker.recordSuccess()
+				return r
+			ep.breaker.recordFailure()
+			error = None
+		finally:
+			endpointPool.end(ep, time.perf_counter() - start)
+		failed.add(ep)
+		if attempt + 1 == retryPolicy.attempts:
+			break
+		# ほかに使えるエンジンがなく、同じエンジンに送り直すときだけ待つ
+		if not ep.breaker.isOpen() and (endpoint or endpointPool.choose(speaker, failed)) in failed:
+			_waitRetry(retryPolicy.delay(attempt))
+	retryPolicy.exhausted += 1
+	raise Exception(f"request to /{ path } failed.") from error
+
+
+def _waitRetry(delay):
+	# 合成スレッドでは、待っている間にstop()されたら、すぐにやめて次の読み上げに移る
+	if threading.current_thread() is not bgThread:
+		time.sleep(delay)
+		return
+	deadline = time.monotonic() + delay
+	with _stopCondition:
+		while _synthGeneration == generation:
+			remaining = deadline - time.monotonic()
+			if remaining <= 0:
+				break
+			_stopCondition.wait(remaining)
+	_checkCancelled()
+
+
+def _probe(ep):
+	r = getSession().get(f"http://{ ep.name }/version", timeout=(1.0, 3.0))
+	if r.status_code != 200:
+		return False
+	# 再起動などで話者の構成が変わっている場合があるので、確認し直す
+	_getSpeakers(ep, getSession().get)
+	# 再起動されたエンジンでは、話者を読み込み直す必要がある
+	_scheduleWarmUp(config.conf["VSU_synth"]["recentStyles"])
+	return True
+
+
+def getEngineStats():
+	return {
+		"retry": retryPolicy.getStats(),
+		"probes": healthProbe.probes if healthProbe else 0,
+		"endpoints": endpointPool.getStats(),
+		"supervisor": supervisor.getStats() if supervisor else None,
+	}
+
+
+def _abortRequests(thread):
+	if thread is None:
+		return
+	with _activeConnectionsLock:
+		conn = _activeConnections.get(thread.ident)
+	if conn is None or conn.sock is None:
+		return
+	try:
+		# ブロックしている受信を即座に終わらせる
+		conn.sock.shutdown(socket.SHUT_RDWR)
+	except OSError:
+		pass
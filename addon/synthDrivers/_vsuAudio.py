@@ -0,0 +1,328 @@
+# Copyright (C) 2026 ACT Laboratory
+
+import audioop
+import struct
+import threading
+from collections import deque
+
+
+class WaveFormatError(Exception):
+	pass
+
+
+class RiffReader:
+	"""Incremental parser of a RIFF/WAVE stream.
+
+	Bytes are given to feed() as they arrive, and the payload of the data chunk is returned as memoryviews
+	over the given bytes, aligned to whole sample frames.
+	Chunks other than fmt and data (LIST and so on) are skipped.
+	"""
+
+	def __init__(self):
+		self.channels = None
+		self.samplesPerSec = None
+		self.bitsPerSample = None
+		self.blockAlign = 2
+		self._header = b""
+		self._started = False
+		# 現在のチャンクの種類と残りバイト数
+		self._chunk = None
+		self._remaining = 0
+		self._pad = 0
+		self._fmt = b""
+		# 前回のブロックの末尾で、サンプルの途中で切れていた分
+		self._carry = b""
+
+	def feed(self, data):
+		ret = []
+		view = memoryview(data)
+		while len(view):
+			if self._chunk is None:
+				# RIFFヘッダまたはチャンクヘッダを読む
+				need = (8 if self._started else 12) - len(self._header)
+				self._header += bytes(view[:need])
+				view = view[need:]
+				if len(self._header) < (8 if self._started else 12):
+					break
+				if not self._started:
+					if self._header[:4] != b"RIFF" or self._header[8:12] != b"WAVE":
+						raise WaveFormatError("not a RIFF/WAVE stream")
+					self._started = True
+				else:
+					self._chunk = self._header[:4]
+					self._remaining = struct.unpack("<I", self._header[4:8])[0]
+					# 奇数長のチャンクの後には1バイトの詰め物がある
+					self._pad = self._remaining & 1 if self._chunk != b"data" else 0
+				self._header = b""
+				continue
+			part = view[:self._remaining]
+			view = view[len(part):]
+			self._remaining -= len(part)
+			if self._chunk == b"fmt ":
+				self._fmt += bytes(part)
+				if self._remaining == 0:
+					self._parseFormat()
+			elif self._chunk == b"data":
+				part = self._align(part)
+				if len(part):
+					ret.append(part)
+			if self._remaining == 0:
+				if self._pad and len(view):
+					view = view[1:]
+					self._pad = 0
+				if not self._pad:
+					self._chunk = None
+		return ret
+
+	def _align(self, part):
+		if self._carry:
+			part = memoryview(self._carry + bytes(part))
+			self._carry = b""
+		extra = len(part) % self.blockAlign
+		if extra:
+			self._carry = bytes(part[len(part) - extra:])
+			part = part[:len(part) - extra]
+		return part
+
+	def _parseFormat(self):
+		if len(self._fmt) < 16:
+			raise WaveFormatError("fmt chunk is too short")
+		tag, self.channels, self.samplesPerSec, byteRate, self.blockAlign, self.bitsPerSample = struct.unpack(
+			"<HHIIHH", self._fmt[:16])
+		if tag != 1:
+			raise WaveFormatError("unsupported format tag %d" % tag)
+
+
+def parseWave(data):
+	"""Returns the data chunk of a whole WAV file as a memoryview, together with its RiffReader."""
+	reader = RiffReader()
+	parts = reader.feed(data)
+	if len(parts) == 1:
+		return parts[0], reader
+	return memoryview(b"".join(parts)), reader
+
+
+# Voicevoxは24kHzで、256サンプルを1フレームとして音素の長さを決める
+ENGINE_RATE = 24000
+FRAME_SIZE = 256
+# 疑問文の語尾を上げるために、エンジンが合成時に疑問のアクセント句の最後に加えるモーラの長さ(秒)
+UPSPEAK_LENGTH = 0.15
+
+
+def phraseOffsets(query):
+	"""Returns the byte offset in the synthesized PCM where each accent phrase of query starts.
+
+	The offset of the end of the last phrase is appended. Lengths are rounded to frames phoneme by phoneme
+	as the engine does, so the offsets are accurate to the sample frame of the engine.
+	The mora the engine adds to interrogative phrases (enable_interrogative_upspeak, on by default) is counted too.
+	"""
+	speed = query["speedScale"]
+
+	def frames(length):
+		return round(length / speed * ENGINE_RATE / FRAME_SIZE)
+
+	count = frames(query["prePhonemeLength"])
+	ret = []
+	for phrase in query["accent_phrases"]:
+		ret.append(count)
+		moras = list(phrase["moras"])
+		if moras and phrase.get("is_interrogative") and moras[-1]["pitch"] != 0:
+			# 最後のモーラの母音を伸ばして語尾を上げる
+			moras.append({"vowel_length": UPSPEAK_LENGTH})
+		if phrase.get("pause_mora"):
+			moras.append(phrase["pause_mora"])
+		for mora in moras:
+			if mora.get("consonant_length") is not None:
+				count += frames(mora["consonant_length"])
+			count += frames(mora["vowel_length"])
+	ret.append(count)
+	samplesPerFrame = FRAME_SIZE * query["outputSamplingRate"] / ENGINE_RATE
+	# 16ビットのモノラル
+	return [int(count * samplesPerFrame) * 2 for count in ret]
+
+
+def findSound(data, threshold, window):
+	"""Returns the byte range from the first to the last window of 16-bit PCM whose peak reaches threshold.
+
+	Returns None if the whole data is quieter than threshold. The range is aligned to window bytes,
+	which must be a multiple of the sample size.
+	"""
+	length = len(data) - len(data) % 2
+	start = 0
+	while start < length and audioop.max(data[start:start + window], 2) < threshold:
+		start += window
+	if start >= length:
+		return None
+	end = length
+	# 末尾の窓から遡る。窓の区切りはstartに揃える
+	last = start + (end - start - 1) // window * window
+	while last > start and audioop.max(data[last:end], 2) < threshold:
+		end = last
+		last -= window
+	return start, end
+
+
+def trimSilence(data, threshold, window, guard):
+	"""Returns data without quiet parts longer than guard bytes at both ends, and the number of bytes removed."""
+	span = findSound(data, threshold, window)
+	if span is None:
+		return data[:0], len(data)
+	start = max(0, span[0] - guard)
+	end = min(len(data), span[1] + guard)
+	return data[start:end], len(data) - (end - start)
+
+
+class SilenceTrimmer:
+	"""Trims silence at both ends of PCM that arrives in blocks.
+
+	Leading quiet blocks are dropped as they come, except for the last guard bytes, which are played before
+	the sound. Quiet parts at the end of a block are held back until sound follows, and all but guard bytes
+	of them are dropped by finish().
+	Items are (view, region) pairs passed through to the caller; empty views only carry a region to release.
+	"""
+
+	def __init__(self, threshold, window, guard):
+		self.threshold = threshold
+		self.window = window
+		self.guard = guard
+		self.trimmed = 0
+		self._started = False
+		self._held = []
+		# 音の前に残すかもしれない、先頭の無音のブロック
+		self._lead = []
+
+	def feed(self, view, region):
+		span = findSound(view, self.threshold, self.window)
+		if span is None:
+			if self._started:
+				self._held.append((view, region))
+				return []
+			self._lead.append((view, region))
+			# 後ろのブロックだけでguardに足りれば、先頭のブロックは要らない
+			ret = []
+			while self._lead and sum(len(v) for v, r in self._lead[1:]) >= self.guard:
+				v, r = self._lead.pop(0)
+				self.trimmed += len(v)
+				ret.append((v[:0], r))
+			return ret
+		start, end = span
+		ret = []
+		if self._started:
+			start = 0
+			ret.extend(self._held)
+			self._held = []
+		else:
+			# このブロックで足りない分は、前の無音のブロックの末尾から補う
+			skip = sum(len(v) for v, r in self._lead) - max(0, self.guard - start)
+			for v, r in self._lead:
+				cut = min(max(0, skip), len(v))
+				skip -= cut
+				self.trimmed += cut
+				ret.append((v[cut:], r))
+			self._lead = []
+			start = max(0, start - self.guard)
+			self.trimmed += start
+			self._started = True
+		if end + self.guard >= len(view):
+			ret.append((view[start:], region))
+		else:
+			ret.append((view[start:end], None))
+			self._held.append((view[end:], region))
+		return ret
+
+	def finish(self):
+		ret = []
+		for view, region in self._lead:
+			self.trimmed += len(view)
+			ret.append((view[:0], region))
+		self._lead = []
+		keep = self.guard
+		for view, region in self._held:
+			length = min(keep, len(view))
+			keep -= length
+			self.trimmed += len(view) - length
+			ret.append((view[:length], region))
+		self._held = []
+		return ret
+
+
+class PcmRing:
+	"""Preallocated buffer that received PCM is written into and played from.
+
+	The synthesis thread reserves a region, reads into it and hands memoryviews of it to the player.
+	Regions may be released in any order; their space is reused once every older region is released too.
+	clear() drops all regions at once without touching the memory, so stopping speech does not depend on
+	how much audio was queued.
+	"""
+
+	def __init__(self, size):
+		self.size = size
+		self._view = memoryview(bytearray(size))
+		# [開始位置, 終了位置, 解放済みか, 確保したときのepoch]
+		self._regions = deque()
+		self._head = 0
+		self._epoch = 0
+		self.used = 0
+		self.peak = 0
+		self.overflows = 0
+		self._lock = threading.Lock()
+
+	def reserve(self, length):
+		"""Returns a (region, writable view) pair for length bytes, or None when there is no room."""
+		with self._lock:
+			start = self._findSpace(length)
+			if start is None:
+				self.overflows += 1
+				return None
+			region = [start, start + length, False, self._epoch]
+			self._regions.append(region)
+			self._head = start + length
+			self.used += length
+			self.peak = max(self.peak, self.used)
+			return region, self._view[start:start + length]
+
+	def _findSpace(self, length):
+		if not self._regions:
+			return 0 if length <= self.size else None
+		tail = self._regions[0][0]
+		if self._head > tail:
+			if self._head + length <= self.size:
+				return self._head
+			# 末尾に入りきらなければ、先頭に戻る
+			return 0 if length <= tail else None
+		return self._head if self._head + length <= tail else None
+
+	def commit(self, region, length):
+		"""Shrinks the most recently reserved region to the length actually written."""
+		with self._lock:
+			if region[3] != self._epoch or not self._regions or self._regions[-1] is not region:
+				return
+			self.used -= region[1] - region[0] - length
+			region[1] = region[0] + length
+			self._head = region[1]
+
+	def release(self, region):
+		with self._lock:
+			if region[3] != self._epoch or region[2]:
+				return
+			region[2] = True
+			self.used -= region[1] - region[0]
+			while self._regions and self._regions[0][2]:
+				self._regions.popleft()
+
+	def clear(self):
+		with self._lock:
+			self._regions.clear()
+			self._head = 0
+			self._epoch += 1
+			self.used = 0
+
+	def getStats(self):
+		with self._lock:
+			return {
+				"size": self.size,
+				"used": self.used,
+				"peak": self.peak,
+				"regions": len(self._regions),
+				"overflows": self.overflows,
+			}
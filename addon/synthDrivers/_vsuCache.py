@@ -0,0 +1,120 @@
+# Copyright (C) 2026 ACT Laboratory
+
+import threading
+from collections import OrderedDict
+
+
+class _Pending:
+	def __init__(self):
+		self.event = threading.Event()
+		self.value = None
+		self.error = None
+
+
+class LRUCache:
+	"""Thread safe LRU cache bounded by the total size of its values.
+
+	Concurrent get() calls for the same missing key run create() only once;
+	the other callers wait for its result.
+	"""
+
+	def __init__(self, maxSize, sizeof=len):
+		self.maxSize = maxSize
+		self.sizeof = sizeof
+		self.size = 0
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.shared = 0
+		self._entries = OrderedDict()
+		self._pending = {}
+		self._lock = threading.Lock()
+
+	def get(self, key, create):
+		with self._lock:
+			if key in self._entries:
+				self._entries.move_to_end(key)
+				self.hits += 1
+				return self._entries[key]
+			pending = self._pending.get(key)
+			if pending is None:
+				pending = self._pending[key] = _Pending()
+				self.misses += 1
+				owner = True
+			else:
+				self.shared += 1
+				owner = False
+		if not owner:
+			pending.event.wait()
+			if pending.error is not None:
+				raise pending.error
+			return pending.value
+		try:
+			pending.value = create()
+		except BaseException as e:
+			pending.error = e
+			raise
+		finally:
+			with self._lock:
+				del self._pending[key]
+				if pending.error is None:
+					self._put(key, pending.value)
+			pending.event.set()
+		return pending.value
+
+	def peek(self, key):
+		"""Returns the cached value or None without creating it."""
+		with self._lock:
+			if key in self._entries:
+				self._entries.move_to_end(key)
+				self.hits += 1
+				return self._entries[key]
+			self.misses += 1
+			return None
+
+	def put(self, key, value):
+		with self._lock:
+			self._put(key, value)
+
+	def _put(self, key, value):
+		size = self.sizeof(value)
+		if size > self.maxSize:
+			# 予算より大きいものは保持しない
+			return
+		if key in self._entries:
+			self.size -= self.sizeof(self._entries.pop(key))
+		self._entries[key] = value
+		self.size += size
+		self._evict()
+
+	def _evict(self):
+		while self.size > self.maxSize and self._entries:
+			key, value = self._entries.popitem(last=False)
+			self.size -= self.sizeof(value)
+			self.evictions += 1
+
+	def clear(self):
+		with self._lock:
+			self._entries.clear()
+			self.size = 0
+
+	def __len__(self):
+		return len(self._entries)
+
+	def __contains__(self, key):
+		# 統計や順序には影響しない
+		return key in self._entries
+
+	def getStats(self):
+		with self._lock:
+			lookups = self.hits + self.misses
+			return {
+				"entries": len(self._entries),
+				"size": self.size,
+				"maxSize": self.maxSize,
+				"hits": self.hits,
+				"misses": self.misses,
+				"shared": self.shared,
+				"evictions": self.evictions,
+				"hitRate": self.hits / lookups if lookups else 0.0,
+			}
@@ -0,0 +1,210 @@
+# Copyright (C) 2026 ACT Laboratory
+
+import hashlib
+import json
+import mmap
+import os
+import threading
+from collections import OrderedDict
+from logHandler import log
+
+DATA_FILE = "audio.dat"
+INDEX_FILE = "index.dat"
+FORMAT_VERSION = 1
+
+
+def makeKey(*params):
+	"""Returns a content address for the given synthesis parameters."""
+	return hashlib.sha1(repr(params).encode("utf-8")).hexdigest()
+
+
+class DiskCache:
+	"""Persistent cache of PCM segments.
+
+	Segments are appended to a single data file and located through an index file,
+	whose lines are appended as entries are added or evicted.
+	Hits are returned as memoryviews over a memory map of the data file, so they are not copied.
+	Evicted segments stay in the data file until it is compacted, which happens when the cache is opened or closed.
+	Compacting copies the whole file, so it is not done while speaking: once the file grows to twice the size limit,
+	new segments are not added until the cache is opened again.
+	The whole cache is dropped when the engine signature changes.
+	"""
+
+	def __init__(self, path, maxSize, signature):
+		self.path = path
+		self.maxSize = maxSize
+		self.signature = signature
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.full = False
+		# key -> (offset, length)。先頭ほど長く使われていない
+		self._entries = OrderedDict()
+		self._live = 0
+		self._dataSize = 0
+		self._map = None
+		self._data = None
+		self._index = None
+		self._lock = threading.Lock()
+		os.makedirs(path, exist_ok=True)
+		if not self._load():
+			self._reset()
+		elif self._shouldCompact():
+			self._compact()
+		self._open()
+
+	def _dataPath(self):
+		return os.path.join(self.path, DATA_FILE)
+
+	def _indexPath(self):
+		return os.path.join(self.path, INDEX_FILE)
+
+	def _load(self):
+		try:
+			with open(self._indexPath(), "r", encoding="utf-8") as f:
+				header = json.loads(f.readline())
+				if header.get("version") != FORMAT_VERSION or header.get("signature") != self.signature:
+					log.debug("VSU: engine changed, disk cache invalidated")
+					return False
+				for line in f:
+					try:
+						record = json.loads(line)
+					except ValueError:
+						# 書き込み途中で終了した行は無視する
+						break
+					if record[0] == "-":
+						self._remove(record[1])
+					else:
+						self._remove(record[0])
+						self._entries[record[0]] = (record[1], record[2])
+						self._live += record[2]
+			self._dataSize = os.path.getsize(self._dataPath())
+		except (OSError, ValueError, IndexError, KeyError):
+			return False
+		# データファイルが途中で切れている場合に備える
+		for key, (offset, length) in list(self._entries.items()):
+			if offset + length > self._dataSize:
+				self._remove(key)
+		return True
+
+	def _reset(self):
+		self._entries.clear()
+		self._live = 0
+		self._dataSize = 0
+		with open(self._dataPath(), "wb"):
+			pass
+		self._writeIndex()
+
+	def _writeIndex(self):
+		tmp = self._indexPath() + ".tmp"
+		with open(tmp, "w", encoding="utf-8") as f:
+			f.write(json.dumps({"version": FORMAT_VERSION, "signature": self.signature}) + "\n")
+			for key, (offset, length) in self._entries.items():
+				f.write(json.dumps([key, offset, length]) + "\n")
+		os.replace(tmp, self._indexPath())
+
+	def _shouldCompact(self):
+		# 追い出した区間が生きている区間より多いか、次のセッションで追加できる余地が少ないときに詰め直す
+		return self._dataSize - self._live > self._live or self._dataSize > self.maxSize * 3 // 2
+
+	def _compact(self):
+		# 生きている区間だけを新しいデータファイルに詰め直す
+		tmp = self._dataPath() + ".tmp"
+		entries = OrderedDict()
+		offset = 0
+		with open(self._dataPath(), "rb") as src, open(tmp, "wb") as dst:
+			for key, (old, length) in self._entries.items():
+				src.seek(old)
+				dst.write(src.read(length))
+				entries[key] = (offset, length)
+				offset += length
+		os.replace(tmp, self._dataPath())
+		self._entries = entries
+		self._dataSize = offset
+		self._writeIndex()
+		log.debug("VSU: disk cache compacted to %d bytes" % offset)
+
+	def _open(self):
+		self._data = open(self._dataPath(), "r+b")
+		self._data.seek(0, os.SEEK_END)
+		self._index = open(self._indexPath(), "a", encoding="utf-8")
+
+	def _remove(self, key):
+		entry = self._entries.pop(key, None)
+		if entry is not None:
+			self._live -= entry[1]
+
+	def get(self, key):
+		"""Returns a memoryview of the cached PCM or None."""
+		with self._lock:
+			entry = self._entries.get(key)
+			if entry is None or self._data is None:
+				self.misses += 1
+				return None
+			self._entries.move_to_end(key)
+			self.hits += 1
+			offset, length = entry
+			if self._map is None or len(self._map) < offset + length:
+				# 追記された分を含めてマップし直す。古いマップは参照がなくなった時点で閉じられる
+				self._map = mmap.mmap(self._data.fileno(), self._dataSize)
+			return memoryview(self._map)[offset:offset + length]
+
+	def put(self, key, data):
+		length = len(data)
+		with self._lock:
+			if self._data is None or key in self._entries or length > self.maxSize:
+				return
+			if self._dataSize + length > self.maxSize * 2:
+				# 追い出した区間が溜まりすぎた。詰め直しは合成を止めてしまううえ、Windowsでは使用中のマップがあると
+				# ファイルを置き換えられないので、閉じるときか次に開くときまで追加しない
+				if not self.full:
+					self.full = True
+					log.debug("VSU: disk cache is full until it is compacted")
+				return
+			self._data.write(data)
+			self._data.flush()
+			self._entries[key] = (self._dataSize, length)
+			self._index.write(json.dumps([key, self._dataSize, length]) + "\n")
+			self._dataSize += length
+			self._live += length
+			while self._live > self.maxSize:
+				old = next(iter(self._entries))
+				self._remove(old)
+				self._index.write(json.dumps(["-", old]) + "\n")
+				self.evictions += 1
+			self._index.flush()
+
+	def close(self):
+		"""Closes the cache. Views returned by get() must not be used after this."""
+		with self._lock:
+			if self._data is None:
+				return
+			self._index.close()
+			self._data.close()
+			self._index = None
+			self._data = None
+			self._map = None
+			try:
+				if self._shouldCompact():
+					self._compact()
+				else:
+					# 使われた順序を保存する
+					self._writeIndex()
+			except OSError:
+				# まだ参照されているマップがあるなどの場合は、次に開いたときに詰め直す
+				log.debug("VSU: disk cache compaction postponed", exc_info=True)
+
+	def getStats(self):
+		with self._lock:
+			lookups = self.hits + self.misses
+			return {
+				"entries": len(self._entries),
+				"size": self._live,
+				"fileSize": self._dataSize,
+				"maxSize": self.maxSize,
+				"hits": self.hits,
+				"misses": self.misses,
+				"evictions": self.evictions,
+				"full": self.full,
+				"hitRate": self.hits / lookups if lookups else 0.0,
+			}
@@ -0,0 +1,202 @@
+# Copyright (C) 2026 ACT Laboratory
+
+import random
+import threading
+import time
+from collections import OrderedDict
+from logHandler import log
+
+
+class EngineUnavailable(Exception):
+	"""Raised without contacting the engine while its circuit breaker is open."""
+
+
+class RetryPolicy:
+	"""Decides how often and how long to wait before retrying a failed engine request.
+
+	Delays grow exponentially from baseDelay up to maxDelay, and a random part of each delay is dropped
+	so that retries from several threads do not hit the engine at the same moment.
+	"""
+
+	def __init__(self, attempts=10, baseDelay=0.05, maxDelay=2.0, jitter=0.5):
+		self.attempts = attempts
+		self.baseDelay = baseDelay
+		self.maxDelay = maxDelay
+		self.jitter = jitter
+		self.retries = 0
+		self.exhausted = 0
+
+	def delay(self, attempt):
+		delay = min(self.maxDelay, self.baseDelay * (2 ** attempt))
+		return delay * (1 - self.jitter * random.random())
+
+	def getStats(self):
+		return {"retries": self.retries, "exhausted": self.exhausted}
+
+
+class CircuitBreaker:
+	"""Fails fast while an engine endpoint keeps failing.
+
+	The breaker opens after failureThreshold consecutive failures.
+	While open, requests are rejected until resetTimeout has passed, after which one trial request is let through,
+	or until the health probe sees the endpoint answering again.
+	"""
+	CLOSED = "closed"
+	OPEN = "open"
+	HALF_OPEN = "halfOpen"
+
+	def __init__(self, name, failureThreshold=5, resetTimeout=5.0):
+		self.name = name
+		self.failureThreshold = failureThreshold
+		self.resetTimeout = resetTimeout
+		self.state = self.CLOSED
+		self.failures = 0
+		self.openedAt = 0
+		self.opened = 0
+		self.rejected = 0
+		self._lock = threading.Lock()
+
+	def allow(self):
+		with self._lock:
+			if self.state == self.CLOSED:
+				return True
+			if self.state == self.OPEN and time.monotonic() - self.openedAt >= self.resetTimeout:
+				# 1回だけ試しに通す
+				self.state = self.HALF_OPEN
+				return True
+			self.rejected += 1
+			return False
+
+	def recordSuccess(self):
+		with self._lock:
+			self.failures = 0
+			self.state = self.CLOSED
+
+	def recordFailure(self):
+		with self._lock:
+			self.failures += 1
+			if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.failureThreshold):
+				if self.state == self.CLOSED:
+					log.warning("VSU: engine %s is not responding" % self.name)
+				self.state = self.OPEN
+				self.openedAt = time.monotonic()
+				self.opened += 1
+
+	def isOpen(self):
+		return self.state != self.CLOSED
+
+	def getStats(self):
+		with self._lock:
+			return {
+				"state": self.state,
+				"failures": self.failures,
+				"opened": self.opened,
+				"rejected": self.rejected,
+			}
+
+
+class Endpoint:
+	"""One engine process, addressed as host:port."""
+
+	# 応答時間の移動平均で、新しい値に与える重み
+	LATENCY_WEIGHT = 0.2
+
+	def __init__(self, name):
+		self.name = name
+		self.breaker = CircuitBreaker(name)
+		self.outstanding = 0
+		self.requests = 0
+		self.latency = None
+		# 提供している話者(スタイル)のID。Noneなら未確認
+		self.speakers = None
+
+	def supports(self, speaker):
+		return speaker is None or self.speakers is None or str(speaker) in self.speakers
+
+	def getStats(self):
+		stats = self.breaker.getStats()
+		stats.update({
+			"outstanding": self.outstanding,
+			"requests": self.requests,
+			"latency": self.latency,
+			"speakers": len(self.speakers) if self.speakers is not None else None,
+		})
+		return stats
+
+
+class EndpointPool:
+	"""Routes requests to the least loaded healthy endpoint.
+
+	The load of an endpoint is its number of outstanding requests weighted by its recent latency.
+	Endpoints whose breaker is open are left out until the health probe closes it again.
+	"""
+
+	def __init__(self, names):
+		self.endpoints = OrderedDict((name, Endpoint(name)) for name in names)
+		self._lock = threading.Lock()
+
+	def choose(self, speaker=None, exclude=()):
+		"""Returns the endpoint to send the next request to, or None if no endpoint has the speaker."""
+		with self._lock:
+			candidates = [ep for ep in self.endpoints.values() if ep.supports(speaker)]
+			healthy = [ep for ep in candidates if not ep.breaker.isOpen() and ep not in exclude]
+			if not healthy:
+				# 全滅している場合は、ブレーカーに判断させる
+				healthy = [ep for ep in candidates if ep not in exclude] or candidates
+			if not healthy:
+				return None
+			return min(healthy, key=self._load)
+
+	def _load(self, ep):
+		latency = ep.latency if ep.latency is not None else 0.0
+		return (ep.outstanding + 1) * (latency + 0.001)
+
+	def begin(self, ep):
+		with self._lock:
+			ep.outstanding += 1
+			ep.requests += 1
+
+	def end(self, ep, elapsed):
+		with self._lock:
+			ep.outstanding -= 1
+			if ep.latency is None:
+				ep.latency = elapsed
+			else:
+				ep.latency += (elapsed - ep.latency) * ep.LATENCY_WEIGHT
+
+	def getStats(self):
+		with self._lock:
+			return {name: ep.getStats() for name, ep in self.endpoints.items()}
+
+
+class HealthProbe(threading.Thread):
+	"""Polls endpoints whose breaker is open and closes it when they answer again.
+
+	probe is called with the endpoint and must return True when it is healthy.
+	"""
+
+	def __init__(self, pool, probe, interval=1.0):
+		super().__init__(name=f"{self.__class__.__module__}.{self.__class__.__qualname__}")
+		self.daemon = True
+		self.pool = pool
+		self.probe = probe
+		self.interval = interval
+		self.probes = 0
+		self._stopEvent = threading.Event()
+
+	def run(self):
+		while not self._stopEvent.wait(self.interval):
+			for ep in list(self.pool.endpoints.values()):
+				if not ep.breaker.isOpen():
+					continue
+				self.probes += 1
+				try:
+					healthy = self.probe(ep)
+				except Exception:
+					healthy = False
+				if healthy:
+					log.info("VSU: engine %s is back" % ep.name)
+					ep.breaker.recordSuccess()
+
+	def stop(self):
+		self._stopEvent.set()
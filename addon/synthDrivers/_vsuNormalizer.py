@@ -0,0 +1,134 @@
+# Copyright (C) 2026 ACT Laboratory
+
+import re
+import unicodedata
+from logHandler import log
+from . import _vsuCache
+
+# 最近変換した文字列を覚えておく数
+MEMO_SIZE = 1024
+DICTIONARY_GROUP = "dictionary"
+
+
+def buildTriePattern(words):
+	"""Returns a regular expression matching any of words, built as a trie.
+
+	Unlike a plain alternation, matching at each position only follows the branch of the next character,
+	so the cost does not grow with the number of words. The longest word is preferred.
+	"""
+	trie = {}
+	for word in words:
+		node = trie
+		for ch in word:
+			node = node.setdefault(ch, {})
+		node[""] = None
+	return _renderTrie(trie)
+
+
+def _renderTrie(node):
+	alternatives = []
+	chars = []
+	for ch in sorted(key for key in node if key):
+		rest = _renderTrie(node[ch])
+		if rest:
+			alternatives.append(re.escape(ch) + rest)
+		else:
+			chars.append(re.escape(ch))
+	if len(chars) == 1:
+		alternatives.append(chars[0])
+	elif chars:
+		alternatives.append("[" + "".join(chars) + "]")
+	if not alternatives:
+		return ""
+	if len(alternatives) == 1 and "" not in node:
+		return alternatives[0]
+	body = "(?:" + "|".join(alternatives) + ")"
+	if "" in node:
+		# ここで終わる単語もある。長い方を優先する
+		body += "?"
+	return body
+
+
+def loadReadings(path):
+	"""Reads a reading dictionary file.
+
+	Each line holds a word and its reading separated by a tab. Empty lines and lines starting with # are ignored.
+	"""
+	readings = {}
+	with open(path, "r", encoding="utf-8-sig") as f:
+		for number, line in enumerate(f, 1):
+			line = line.rstrip("\r\n")
+			if not line.strip() or line.startswith("#"):
+				continue
+			fields = line.split("\t")
+			if len(fields) < 2 or not fields[0]:
+				log.warning("VSU: ignored line %d of %s" % (number, path))
+				continue
+			readings[fields[0]] = fields[1]
+	return readings
+
+
+class Normalizer:
+	"""Rewrites text for the engine in a single pass.
+
+	All rules and the words of the reading dictionary are compiled into one regular expression,
+	and each match is replaced through a table indexed by the name of the group that matched.
+	Words of the dictionary take precedence over the rules. Results for recent strings are memoized.
+	"""
+
+	def __init__(self, rules=(), readings=None, nfkc=True, memoSize=MEMO_SIZE):
+		self.nfkc = nfkc
+		self.readings = {}
+		for word, reading in (readings or {}).items():
+			self.readings[self._fold(word)] = reading
+		self._dispatch = {}
+		groups = []
+		if self.readings:
+			groups.append("(?P<%s>%s)" % (DICTIONARY_GROUP, buildTriePattern(self.readings)))
+			self._dispatch[DICTIONARY_GROUP] = self._reading
+		for i, (pattern, replacement) in enumerate(rules):
+			name = "r%d" % i
+			groups.append("(?P<%s>%s)" % (name, pattern))
+			if callable(replacement):
+				# まとめた正規表現ではグループの番号がずれるので、規則単体の結果を渡す
+				self._dispatch[name] = self._makeCallback(re.compile(pattern), replacement)
+			else:
+				self._dispatch[name] = replacement
+		self._pattern = re.compile("|".join(groups)) if groups else None
+		self._memo = _vsuCache.LRUCache(memoSize, sizeof=lambda text: 1)
+
+	@staticmethod
+	def _makeCallback(pattern, replacement):
+		return lambda match: replacement(pattern.match(match.string, match.start()))
+
+	def _fold(self, text):
+		if self.nfkc:
+			# 全角英数字・半角カナなどの表記の揺れをまとめる
+			return unicodedata.normalize("NFKC", text)
+		return text
+
+	def normalize(self, text):
+		if not self._memo.maxSize:
+			return self._normalize(text)
+		return self._memo.get(text, lambda: self._normalize(text))
+
+	def _normalize(self, text):
+		text = self._fold(text)
+		if self._pattern is None:
+			return text
+		return self._pattern.sub(self._replace, text)
+
+	def _replace(self, match):
+		replacement = self._dispatch[match.lastgroup]
+		if callable(replacement):
+			return replacement(match)
+		return replacement
+
+	def _reading(self, match):
+		return self.readings[match.group()]
+
+	def getStats(self):
+		stats = self._memo.getStats()
+		stats["readings"] = len(self.readings)
+		stats["rules"] = len(self._dispatch)
+		return stats
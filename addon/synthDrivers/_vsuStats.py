@@ -0,0 +1,113 @@
+# Copyright (C) 2026 ACT Laboratory
+
+import bisect
+import time
+
+# 時間(ミリ秒)の分布を数える区切り
+TIME_BOUNDS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+# 実時間比(合成にかかった時間/音声の長さ)の区切り
+RATIO_BOUNDS = (0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5)
+# 待ち行列の長さの区切り
+DEPTH_BOUNDS = (0, 1, 2, 4, 8, 16, 32, 64)
+# バイト数の区切り
+SIZE_BOUNDS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+class Histogram:
+	"""Counts observed values in fixed buckets.
+
+	Memory does not grow with the number of observations, and observe() only does a binary search,
+	so it can be called on every request. Counts may be slightly off when threads observe at the same time,
+	which is accepted to avoid locking.
+	"""
+
+	def __init__(self, bounds):
+		self.bounds = tuple(bounds)
+		# 最後の要素は、最大の区切りを超えたもの
+		self.counts = [0] * (len(self.bounds) + 1)
+		self.count = 0
+		self.total = 0
+		self.max = None
+
+	def observe(self, value):
+		self.counts[bisect.bisect_left(self.bounds, value)] += 1
+		self.count += 1
+		self.total += value
+		if self.max is None or value > self.max:
+			self.max = value
+
+	def percentile(self, fraction):
+		"""Returns the upper bound of the bucket holding the given fraction of observations."""
+		if not self.count:
+			return None
+		target = fraction * self.count
+		seen = 0
+		for bound, count in zip(self.bounds, self.counts):
+			seen += count
+			if seen >= target:
+				return bound
+		return self.max
+
+	def clear(self):
+		self.counts = [0] * (len(self.bounds) + 1)
+		self.count = 0
+		self.total = 0
+		self.max = None
+
+	def getStats(self):
+		return {
+			"count": self.count,
+			"mean": self.total / self.count if self.count else None,
+			"p50": self.percentile(0.5),
+			"p90": self.percentile(0.9),
+			"p99": self.percentile(0.99),
+			"max": self.max,
+			"buckets": dict(zip([str(bound) for bound in self.bounds] + ["more"], self.counts)),
+		}
+
+
+class Recorder:
+	"""A fixed set of named histograms and counters."""
+
+	def __init__(self, histograms, counters=()):
+		self.histograms = {name: Histogram(bounds) for name, bounds in histograms.items()}
+		self.counters = dict.fromkeys(counters, 0)
+		self.since = time.time()
+
+	def observe(self, name, value):
+		self.histograms[name].observe(value)
+
+	def add(self, name, value=1):
+		self.counters[name] += value
+
+	def clear(self):
+		for histogram in self.histograms.values():
+			histogram.clear()
+		self.counters = dict.fromkeys(self.counters, 0)
+		self.since = time.time()
+
+	def getStats(self):
+		return {
+			"since": self.since,
+			"histograms": {name: histogram.getStats() for name, histogram in self.histograms.items()},
+			"counters": dict(self.counters),
+		}
+
+
+def formatSummary(stats):
+	"""Returns stats as readable lines, without the bucket counts."""
+	lines = []
+	for name, histogram in sorted(stats["histograms"].items()):
+		if not histogram["count"]:
+			continue
+		lines.append("%s: count %d, mean %.3g, p50 %s, p90 %s, p99 %s, max %.3g" % (
+			name, histogram["count"], histogram["mean"], histogram["p50"], histogram["p90"], histogram["p99"], histogram["max"]))
+	for name, value in sorted(stats["counters"].items()):
+		lines.append("%s: %d" % (name, value))
+	for name, cache in sorted(stats.get("caches", {}).items()):
+		if cache is None:
+			continue
+		lines.append("%s cache: %d entries, hit rate %.1f%%" % (name, cache["entries"], cache["hitRate"] * 100))
+	for name, value in sorted(stats.get("engine", {}).get("retry", {}).items()):
+		lines.append("engine %s: %d" % (name, value))
+	return lines
@@ -0,0 +1,393 @@
+# Copyright (C) 2026 ACT Laboratory
+
+import ctypes
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+import urllib.request
+from logHandler import log
+from . import _vsuAudio
+
+# Windowsでは、コンソールを表示せず、NVDAより低い優先度でエンジンを動かす
+_CREATION_FLAGS = getattr(subprocess, "CREATE_NO_WINDOW", 0) | getattr(subprocess, "BELOW_NORMAL_PRIORITY_CLASS", 0)
+# 手元のエンジンへの要求には、システムのプロキシ設定を使わない
+_opener = urllib.request.build_opener(urllib.request.ProxyHandler({}))
+
+# 死活確認の応答を待つ時間(秒)
+HEALTH_TIMEOUT = 5.0
+# 死活確認がこの回数続けて失敗したら、固まったとみなして再起動する
+HANG_FAILURES = 3
+# 再起動が続けて失敗するときに、次の起動まで待つ時間の上限(秒)
+RESTART_DELAY_MAX = 60.0
+# これより長く動いていたエンジンの再起動は、待たずに行う(秒)
+STABLE_UPTIME = 60.0
+# スレッド数の計測に合成する文
+CALIBRATION_TEXT = "吾輩は猫である。名前はまだ無い。どこで生まれたかとんと見当がつかぬ。"
+# 最も速いものとの実時間比の差がこの割合以内なら、少ないスレッド数を選ぶ
+CALIBRATION_TOLERANCE = 0.05
+
+
+def freePort(host="127.0.0.1"):
+	"""Returns a TCP port on host that nothing listens on right now."""
+	with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+		sock.bind((host, 0))
+		return sock.getsockname()[1]
+
+
+def defaultThreads():
+	"""Returns the number of CPU threads given to the engine when none is configured."""
+	# NVDA自身の応答のために、論理コアの半分は残しておく
+	return max(1, (os.cpu_count() or 2) // 2)
+
+
+def calibrationCandidates():
+	"""Returns the thread counts tried by calibrate(), leaving at least one logical core to NVDA."""
+	limit = max(1, (os.cpu_count() or 2) - 1)
+	return sorted(set(n for n in (1, 2, 3, 4, 6, 8, 12, 16, defaultThreads()) if n <= limit))
+
+
+class _ProcessMemoryCounters(ctypes.Structure):
+	_fields_ = [
+		("cb", ctypes.c_uint32),
+		("PageFaultCount", ctypes.c_uint32),
+		("PeakWorkingSetSize", ctypes.c_size_t),
+		("WorkingSetSize", ctypes.c_size_t),
+		("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+		("QuotaPagedPoolUsage", ctypes.c_size_t),
+		("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+		("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+		("PagefileUsage", ctypes.c_size_t),
+		("PeakPagefileUsage", ctypes.c_size_t),
+	]
+
+
+_psapi = None
+
+
+def processMemory(process):
+	"""Returns the resident memory of a subprocess.Popen in bytes, or None when it cannot be read."""
+	global _psapi
+	if sys.platform == "win32":
+		if _psapi is None:
+			_psapi = ctypes.WinDLL("psapi")
+			_psapi.GetProcessMemoryInfo.argtypes = (ctypes.c_void_p, ctypes.c_void_p, ctypes.c_uint32)
+		counters = _ProcessMemoryCounters()
+		counters.cb = ctypes.sizeof(counters)
+		# Popenが持っているプロセスのハンドルをそのまま使う
+		if not _psapi.GetProcessMemoryInfo(int(process._handle), ctypes.byref(counters), counters.cb):
+			return None
+		return counters.WorkingSetSize
+	try:
+		with open(f"/proc/{ process.pid }/status", "r") as f:
+			for line in f:
+				if line.startswith("VmRSS:"):
+					return int(line.split()[1]) * 1024
+	except (OSError, ValueError):
+		pass
+	return None
+
+
+class EngineProcess:
+	"""One run of the engine command on 127.0.0.1:port.
+
+	The command line is command, then args, then the host, port and CPU thread options.
+	Output of the engine goes to logFile when given, which is overwritten on every start.
+	"""
+
+	def __init__(self, command, args, port, threads, logFile=None):
+		self.command = command
+		self.args = list(args)
+		self.port = port
+		self.threads = threads
+		self.logFile = logFile
+		self.process = None
+		self.startedAt = None
+
+	@property
+	def endpoint(self):
+		return f"127.0.0.1:{ self.port }"
+
+	def commandLine(self):
+		return [self.command] + self.args + [
+			"--host", "127.0.0.1",
+			"--port", str(self.port),
+			"--cpu_num_threads", str(self.threads),
+		]
+
+	def start(self):
+		output = subprocess.DEVNULL
+		if self.logFile:
+			os.makedirs(os.path.dirname(self.logFile), exist_ok=True)
+			output = open(self.logFile, "wb")
+		# run.exeは自分のフォルダにあるモデルなどを読むので、そこで起動する
+		cwd = os.path.dirname(self.command) or None
+		try:
+			if sys.platform == "win32":
+				self.process = subprocess.Popen(
+					self.commandLine(), cwd=cwd, stdin=subprocess.DEVNULL, stdout=output, stderr=subprocess.STDOUT,
+					creationflags=_CREATION_FLAGS)
+			else:
+				self.process = subprocess.Popen(
+					self.commandLine(), cwd=cwd, stdin=subprocess.DEVNULL, stdout=output, stderr=subprocess.STDOUT,
+					start_new_session=True)
+		finally:
+			if output is not subprocess.DEVNULL:
+				output.close()
+		self.startedAt = time.monotonic()
+
+	def exited(self):
+		return self.process is None or self.process.poll() is not None
+
+	def request(self, method, path, params=None, data=None, timeout=HEALTH_TIMEOUT):
+		url = f"http://{ self.endpoint }/{ path }"
+		if params:
+			url += "?" + urllib.parse.urlencode(params)
+		req = urllib.request.Request(url, data=data, method=method, headers={"Content-Type": "application/json"})
+		with _opener.open(req, timeout=timeout) as r:
+			return r.read()
+
+	def answering(self):
+		try:
+			self.request("GET", "version")
+		except (OSError, ValueError):
+			return False
+		return True
+
+	def waitReady(self, timeout, stopEvent):
+		"""Waits until /version answers. Returns False when the process exits, timeout passes or stopEvent is set."""
+		deadline = time.monotonic() + timeout
+		while time.monotonic() < deadline:
+			if self.exited():
+				return False
+			if self.answering():
+				return True
+			if stopEvent.wait(0.2):
+				return False
+		return False
+
+	def memory(self):
+		if self.exited():
+			return None
+		return processMemory(self.process)
+
+	def kill(self):
+		if self.process is None:
+			return
+		if self.process.poll() is None:
+			# --enable_cancellable_synthesisでは合成用の子プロセスが作られるので、まとめて終了させる
+			try:
+				if sys.platform == "win32":
+					subprocess.run(
+						["taskkill", "/F", "/T", "/PID", str(self.process.pid)],
+						stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+						creationflags=_CREATION_FLAGS, timeout=10)
+				else:
+					os.killpg(self.process.pid, signal.SIGKILL)
+			except (OSError, subprocess.SubprocessError):
+				log.debug("VSU: failed to kill the engine process tree", exc_info=True)
+				self.process.kill()
+		try:
+			self.process.wait(10)
+		except subprocess.TimeoutExpired:
+			log.warning(f"VSU: engine process { self.process.pid } did not exit")
+
+
+class EngineSupervisor:
+	"""Runs the engine command on a free local port and keeps it answering.
+
+	A watchdog thread restarts the engine when the process exits, when /version stops answering
+	or when its memory exceeds memoryLimit bytes. Memory restarts wait while isBusy() returns True.
+	Restarts that keep failing are delayed exponentially. onRestart is called from the watchdog thread
+	each time a restarted engine answers again.
+	"""
+
+	def __init__(self, command, args=(), threads=0, memoryLimit=0, onRestart=None, isBusy=None, logFile=None,
+			startTimeout=120.0, interval=2.0):
+		self.command = command
+		self.args = list(args)
+		self.threads = threads or defaultThreads()
+		self.memoryLimit = memoryLimit
+		self.onRestart = onRestart
+		self.isBusy = isBusy
+		self.logFile = logFile
+		self.startTimeout = startTimeout
+		self.interval = interval
+		self.port = freePort()
+		self.ready = threading.Event()
+		self.starts = 0
+		self.restarts = {"failed": 0, "timeout": 0, "exited": 0, "hung": 0, "memory": 0, "requested": 0}
+		self.memory = None
+		self._engine = None
+		self._requested = False
+		self._lock = threading.Lock()
+		self._stopEvent = threading.Event()
+		self._thread = None
+
+	@property
+	def endpoint(self):
+		return f"127.0.0.1:{ self.port }"
+
+	def start(self):
+		"""Starts the engine and the watchdog without waiting for the engine to answer."""
+		self._thread = threading.Thread(
+			target=self._run, name=f"{self.__class__.__module__}.{self.__class__.__qualname__}", daemon=True)
+		self._thread.start()
+
+	def waitUntilReady(self, timeout=None):
+		return self.ready.wait(timeout)
+
+	def restart(self, threads=None):
+		"""Restarts the engine at once, with a new number of CPU threads when given."""
+		with self._lock:
+			if threads:
+				self.threads = threads
+			self._requested = True
+			engine = self._engine
+		if engine:
+			engine.kill()
+
+	def stop(self):
+		with self._lock:
+			self._stopEvent.set()
+			engine = self._engine
+		self.ready.clear()
+		if engine:
+			engine.kill()
+
+	def _run(self):
+		delay = 1.0
+		while True:
+			with self._lock:
+				if self._stopEvent.is_set():
+					return
+				self._requested = False
+				engine = self._engine = EngineProcess(self.command, self.args, self.port, self.threads, self.logFile)
+				self.starts += 1
+				# stop()と行き違いにならないよう、起動までロックの中で行う
+				try:
+					engine.start()
+					started = True
+				except OSError:
+					log.error(f"VSU: failed to start the engine { self.command }", exc_info=True)
+					started = False
+			if not started:
+				reason = "failed"
+			else:
+				log.info(f"VSU: started the engine on { self.endpoint } with { self.threads } CPU threads")
+				reason = self._watch(engine)
+			self.ready.clear()
+			self.memory = None
+			engine.kill()
+			if self._stopEvent.is_set():
+				return
+			self.restarts[reason] += 1
+			if reason == "requested":
+				log.info("VSU: restarting the engine as requested")
+			else:
+				log.warning(f"VSU: restarting the engine ({ reason })")
+			if reason == "requested" or (engine.startedAt and time.monotonic() - engine.startedAt > STABLE_UPTIME):
+				delay = 1.0
+				continue
+			if self._stopEvent.wait(delay):
+				return
+			delay = min(delay * 2, RESTART_DELAY_MAX)
+
+	def _watch(self, engine):
+		# エンジンが応答するようになるまで待ち、その後は止まるまで様子を見る。再起動する理由を返す
+		if not engine.waitReady(self.startTimeout, self._stopEvent):
+			if self._requested:
+				return "requested"
+			return "exited" if engine.exited() else "timeout"
+		self.ready.set()
+		if self.starts > 1 and self.onRestart:
+			try:
+				self.onRestart()
+			except Exception:
+				log.error("VSU: onRestart failed", exc_info=True)
+		failures = 0
+		while not self._stopEvent.wait(self.interval):
+			if engine.exited():
+				return "requested" if self._requested else "exited"
+			if engine.answering():
+				failures = 0
+			else:
+				failures += 1
+				if failures >= HANG_FAILURES:
+					return "hung"
+			if self.memoryLimit:
+				self.memory = engine.memory()
+				if self.memory is not None and self.memory > self.memoryLimit and not (self.isBusy and self.isBusy()):
+					log.warning(f"VSU: the engine uses { self.memory // 1048576 }MB of memory")
+					return "memory"
+		return "requested"
+
+	def getStats(self):
+		engine = self._engine
+		return {
+			"endpoint": self.endpoint,
+			"pid": engine.process.pid if engine and engine.process else None,
+			"threads": self.threads,
+			"ready": self.ready.is_set(),
+			"uptime": time.monotonic() - engine.startedAt if engine and engine.startedAt and self.ready.is_set() else None,
+			"memory": self.memory,
+			"starts": self.starts,
+			"restarts": dict(self.restarts),
+		}
+
+
+def _measure(engine, speaker, text, rounds):
+	# 合成にかかった時間の、音声の長さに対する比の中央値を返す
+	if speaker is None:
+		speakers = json.loads(engine.request("GET", "speakers"))
+		speaker = str(speakers[0]["styles"][0]["id"])
+	engine.request("POST", "initialize_speaker", {"speaker": speaker, "skip_reinit": "true"}, b"", timeout=300)
+	query = engine.request("POST", "audio_query", {"text": text, "speaker": speaker}, b"", timeout=300)
+	# 最初の合成は準備を含むので数えない
+	engine.request("POST", "synthesis", {"speaker": speaker}, query, timeout=300)
+	ratios = []
+	for i in range(rounds):
+		start = time.perf_counter()
+		wave = engine.request("POST", "synthesis", {"speaker": speaker}, query, timeout=300)
+		elapsed = time.perf_counter() - start
+		data, reader = _vsuAudio.parseWave(wave)
+		ratios.append(elapsed / (len(data) / reader.blockAlign / reader.samplesPerSec))
+	return sorted(ratios)[len(ratios) // 2]
+
+
+def calibrate(command, args=(), candidates=None, speaker=None, text=CALIBRATION_TEXT, rounds=3,
+		startTimeout=120.0, stopEvent=None):
+	"""Starts the engine with each number of CPU threads in candidates and measures its real-time factor.
+
+	Each run uses its own free port, so an engine that is already running is not disturbed.
+	Returns (threads, results): the fewest threads within CALIBRATION_TOLERANCE of the fastest,
+	and a dict mapping each count to its median real-time factor, or to None when the run failed.
+	"""
+	stopEvent = stopEvent or threading.Event()
+	results = {}
+	for threads in candidates or calibrationCandidates():
+		if stopEvent.is_set():
+			break
+		engine = EngineProcess(command, args, freePort(), threads)
+		try:
+			engine.start()
+			if not engine.waitReady(startTimeout, stopEvent):
+				raise Exception("the engine did not answer.")
+			results[threads] = _measure(engine, speaker, text, rounds)
+		except Exception:
+			log.debug(f"VSU: calibration with { threads } threads failed", exc_info=True)
+			results[threads] = None
+		finally:
+			engine.kill()
+		log.info(f"VSU: real-time factor with { threads } CPU threads: { results[threads] }")
+	measured = {threads: ratio for threads, ratio in results.items() if ratio is not None}
+	if not measured:
+		raise Exception("the engine could not be measured with any number of threads.")
+	best = min(measured.values())
+	threads = min(n for n, ratio in measured.items() if ratio <= best * (1 + CALIBRATION_TOLERANCE))
+	return threads, results
@@ -0,0 +1,125 @@
+# Copyright (C) 2026 ACT Laboratory
+
+import re
+
+# 句読点・改行の直後で区切る。区切り文字は直前の文節に含める
+CLAUSE_PATTERN = re.compile(r"[^、。！？!?\n]*[、。！？!?\n]+|[^、。！？!?\n]+")
+SPACE_PATTERN = re.compile(r"\S+\s*")
+# アクセント句のキャッシュ用に、空白と句読点の直後で区切る
+SEGMENT_PATTERN = re.compile(r"[^\s、。！？!?]*[\s、。！？!?]+|[^\s、。！？!?]+")
+
+# 後に文字列が続くときに、Voicevoxが句読点の位置に入れる無音(pause_mora)のおおよその長さ(秒)。話速1.0のとき
+# 文字列の末尾の句読点には無音が入らないので、区切って合成したときはこれを補う
+PAUSE_LENGTHS = {"、": 0.3, ",": 0.3, "。": 0.45, "！": 0.45, "？": 0.45, "!": 0.45, "?": 0.45, ".": 0.45, "\n": 0.45}
+
+# 拗音などの小書き文字は直前の文字と合わせて1モーラになる
+SMALL_KANA = set("ゃゅょぁぃぅぇぉゎャュョァィゥェォヮ")
+
+
+def _charMora(ch):
+	if ch in SMALL_KANA:
+		return 0
+	code = ord(ch)
+	if 0x3041 <= code <= 0x30ff:
+		# ひらがな・カタカナ（っ・ーを含む）
+		return 1
+	if 0x4e00 <= code <= 0x9fff or 0x3400 <= code <= 0x4dbf:
+		# 漢字は平均して2モーラ程度で読まれる
+		return 2
+	if ch.isalnum():
+		# 英数字は1文字ずつ読まれるので、おおむね2モーラ
+		return 2
+	return 0
+
+
+def estimateMora(text):
+	"""Roughly estimates the number of moras Voicevox will read for text."""
+	return sum(_charMora(ch) for ch in text)
+
+
+def _splitLong(clause, maxMora):
+	# 1文節だけで上限を超える場合は、空白、それでも駄目なら文字単位で区切る
+	pieces = []
+	for word in SPACE_PATTERN.findall(clause) or [clause]:
+		if estimateMora(word) <= maxMora:
+			pieces.append(word)
+			continue
+		cur = ""
+		curMora = 0
+		for ch in word:
+			m = _charMora(ch)
+			if cur and curMora + m > maxMora:
+				pieces.append(cur)
+				cur = ""
+				curMora = 0
+			cur += ch
+			curMora += m
+		if cur:
+			pieces.append(cur)
+	return _merge(pieces, maxMora)
+
+
+def _merge(pieces, maxMora):
+	ret = []
+	cur = ""
+	curMora = 0
+	for piece in pieces:
+		m = estimateMora(piece)
+		if cur and curMora + m > maxMora:
+			ret.append(cur)
+			cur = ""
+			curMora = 0
+		cur += piece
+		curMora += m
+	if cur:
+		ret.append(cur)
+	return ret
+
+
+def splitClauses(text, maxMora):
+	"""Splits text at Japanese clause and sentence boundaries.
+
+	The first clause is returned on its own so that it can be synthesized as soon as possible.
+	Following clauses are joined while they fit in maxMora.
+	Chunks without anything to read are dropped.
+	"""
+	clauses = []
+	for clause in CLAUSE_PATTERN.findall(text):
+		if estimateMora(clause) > maxMora:
+			clauses.extend(_splitLong(clause, maxMora))
+		else:
+			clauses.append(clause)
+	clauses = [c for c in clauses if c.strip()]
+	if len(clauses) <= 1:
+		return clauses
+	return clauses[:1] + _merge(clauses[1:], maxMora)
+
+
+def splitSegments(text):
+	"""Splits text after spaces and punctuation, where the accent phrases break anyway.
+
+	Delimiters stay at the end of the preceding segment and blank segments are dropped.
+	"""
+	return [segment for segment in SEGMENT_PATTERN.findall(text) if segment.strip()]
+
+
+def boundaryPause(text):
+	"""Returns how long Voicevox pauses after text when more text follows it, or 0 when it does not end in punctuation."""
+	text = text.rstrip(" \t\u3000")
+	if not text:
+		return 0
+	return PAUSE_LENGTHS.get(text[-1], 0)
+
+
+def withBoundaryPause(phrases, text, length=None):
+	"""Returns the accent phrases of text with the pause Voicevox puts after it when more text follows.
+
+	length overrides the pause length given by boundaryPause(). The given list and its phrases
+	are left unchanged, since they may be cached.
+	"""
+	if length is None:
+		length = boundaryPause(text)
+	if not length or not phrases or phrases[-1].get("pause_mora"):
+		return phrases
+	pause = {"text": "、", "consonant": None, "consonant_length": None, "vowel": "pau", "vowel_length": length, "pitch": 0.0}
+	return phrases[:-1] + [dict(phrases[-1], pause_mora=pause)]
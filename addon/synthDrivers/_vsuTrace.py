@@ -0,0 +1,87 @@
+# Copyright (C) 2026 ACT Laboratory
+
+import os
+import threading
+import time
+from collections import deque
+
+
+class _NullSpan:
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		return False
+
+
+# 記録しないときは、毎回同じものを返して何もしない
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+	__slots__ = ("tracer", "name", "args", "start")
+
+	def __init__(self, tracer, name, args):
+		self.tracer = tracer
+		self.name = name
+		self.args = args
+
+	def __enter__(self):
+		self.start = time.perf_counter()
+		return self
+
+	def __exit__(self, excType, exc, tb):
+		end = time.perf_counter()
+		if excType is not None:
+			self.args["error"] = excType.__name__
+		self.tracer._record(self.name, self.start, end - self.start, self.args)
+		return False
+
+
+class Tracer:
+	"""Records begin and end times of named spans in a bounded ring, for export as Chrome trace events.
+
+	Tracing is off until setSize() is given a positive size. While off, span() returns a shared object
+	that does nothing, so instrumented code only pays for one call.
+	"""
+
+	def __init__(self):
+		self.enabled = False
+		self._events = deque(maxlen=1)
+		self._threads = {}
+
+	def setSize(self, size):
+		if size <= 0:
+			self.enabled = False
+			self._events = deque(maxlen=1)
+			return
+		if size != self._events.maxlen:
+			self._events = deque(self._events, maxlen=size)
+		self.enabled = True
+
+	def span(self, name, **args):
+		if not self.enabled:
+			return _NULL_SPAN
+		return _Span(self, name, args)
+
+	def _record(self, name, start, duration, args):
+		thread = threading.current_thread()
+		self._threads[thread.ident] = thread.name
+		# dequeへの追加はスレッドセーフで、古いものから捨てられる
+		self._events.append((name, start, duration, thread.ident, args))
+
+	def clear(self):
+		self._events.clear()
+
+	def export(self):
+		"""Returns the recorded spans as a Chrome trace-event document (chrome://tracing, Perfetto)."""
+		pid = os.getpid()
+		events = []
+		for ident, name in list(self._threads.items()):
+			events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": ident, "args": {"name": name}})
+		for name, start, duration, ident, args in list(self._events):
+			events.append({
+				"name": name, "cat": "vsu", "ph": "X", "pid": pid, "tid": ident,
+				"ts": start * 1000000, "dur": duration * 1000000, "args": args,
+			})
+		return {"traceEvents": events, "displayTimeUnit": "ms"}
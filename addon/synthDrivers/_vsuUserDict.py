@@ -0,0 +1,89 @@
+# Copyright (C) 2026 ACT Laboratory
+
+import hashlib
+import json
+import os
+import uuid
+from collections import OrderedDict
+from logHandler import log
+
+# 登録した単語のUUIDを表記から決めるための名前空間
+WORD_NAMESPACE = uuid.UUID("6f1c3a52-8d1e-4c63-9b0e-5b2f7a1d4e90")
+DEFAULT_PRIORITY = 5
+
+
+def loadWords(path):
+	"""Reads a user dictionary file.
+
+	Each line holds the surface, the pronunciation in katakana and the accent type separated by tabs,
+	optionally followed by the priority (0-10). Empty lines and lines starting with # are ignored.
+	Returns an OrderedDict mapping surfaces to [pronunciation, accentType, priority].
+	"""
+	words = OrderedDict()
+	with open(path, "r", encoding="utf-8-sig") as f:
+		for number, line in enumerate(f, 1):
+			line = line.rstrip("\r\n")
+			if not line.strip() or line.startswith("#"):
+				continue
+			fields = line.split("\t")
+			try:
+				priority = int(fields[3]) if len(fields) > 3 else DEFAULT_PRIORITY
+				words[fields[0]] = [fields[1], int(fields[2]), priority]
+			except (IndexError, ValueError):
+				log.warning("VSU: ignored line %d of %s" % (number, path))
+	return words
+
+
+def wordId(surface):
+	# 同じ表記には常に同じUUIDを割り当て、差分の更新や削除に使う
+	return str(uuid.uuid5(WORD_NAMESPACE, surface))
+
+
+def contentHash(words):
+	return hashlib.sha1(json.dumps(words, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def toImport(words):
+	"""Returns the body of /import_user_dict for words, registering them as proper nouns."""
+	ret = {}
+	for surface, (pronunciation, accentType, priority) in words.items():
+		ret[wordId(surface)] = {
+			"surface": surface,
+			"priority": priority,
+			"context_id": 1348,
+			"part_of_speech": "名詞",
+			"part_of_speech_detail_1": "固有名詞",
+			"part_of_speech_detail_2": "一般",
+			"part_of_speech_detail_3": "*",
+			"inflectional_type": "*",
+			"inflectional_form": "*",
+			"stem": "*",
+			"yomi": pronunciation,
+			"pronunciation": pronunciation,
+			"accent_type": accentType,
+			"accent_associative_rule": "*",
+		}
+	return ret
+
+
+def diff(old, new):
+	"""Returns the words added or changed in new, and the surfaces removed from old."""
+	changed = OrderedDict((surface, word) for surface, word in new.items() if old.get(surface) != word)
+	removed = [surface for surface in old if surface not in new]
+	return changed, removed
+
+
+def loadState(path):
+	"""Returns what was last pushed to each engine, keyed by endpoint name."""
+	try:
+		with open(path, "r", encoding="utf-8") as f:
+			return json.load(f)
+	except (OSError, ValueError):
+		return {}
+
+
+def saveState(path, state):
+	tmp = path + ".tmp"
+	with open(tmp, "w", encoding="utf-8") as f:
+		json.dump(state, f, ensure_ascii=False)
+	os.replace(tmp, path)
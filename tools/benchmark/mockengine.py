@@ -0,0 +1,297 @@
+# Copyright (C) 2026 ACT Laboratory
+# ベンチマーク用の、Voicevoxエンジンを真似るHTTPサーバー
+
+import argparse
+import io
+import json
+import os
+import random
+import struct
+import sys
+import threading
+import time
+import urllib.parse
+import uuid
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SPEAKERS = [
+	{"name": "Mock1", "speaker_uuid": "mock-1", "styles": [{"name": "normal", "id": 1}, {"name": "sweet", "id": 2}]},
+	{"name": "Mock2", "speaker_uuid": "mock-2", "styles": [{"name": "normal", "id": 3}, {"name": "tsun", "id": 4}]},
+]
+# 失敗させることのある、合成に関わるパス
+FAILING_PATHS = ("/audio_query", "/accent_phrases", "/synthesis", "/cancellable_synthesis", "/multi_synthesis")
+PUNCTUATION = "、。！？!?,."
+# 実際のエンジンのように、音声の前後に付ける小さな雑音の長さ(秒)
+LEAD_NOISE = 0.08
+TAIL_NOISE = 0.15
+
+
+def accentPhrases(text):
+	"""Returns accent phrases with one mora per character, split at punctuation.
+
+	Punctuation followed by more text gives the phrase before it a pause mora, and a question mark at the end
+	marks the last phrase as interrogative, as the engine does.
+	"""
+	phrases = []
+	moras = []
+	for ch in text:
+		if ch in PUNCTUATION:
+			if moras:
+				phrases.append({
+					"moras": moras,
+					"accent": 1,
+					"pause_mora": {"text": "、", "consonant": None, "consonant_length": None, "vowel": "pau", "vowel_length": 0.3, "pitch": 0.0},
+					"is_interrogative": False,
+				})
+				moras = []
+			continue
+		if ch.isspace():
+			continue
+		moras.append({"text": ch, "consonant": "k", "consonant_length": 0.03, "vowel": "a", "vowel_length": 0.09, "pitch": 5.5})
+	if moras:
+		phrases.append({"moras": moras, "accent": 1, "pause_mora": None, "is_interrogative": False})
+	elif phrases:
+		# 実際のエンジンと同じく、文字列の末尾の句読点には無音を入れない
+		phrases[-1]["pause_mora"] = None
+	if phrases and text.rstrip()[-1:] in ("?", "？"):
+		phrases[-1]["is_interrogative"] = True
+	return phrases
+
+
+def audioQuery(text):
+	return {
+		"accent_phrases": accentPhrases(text),
+		"speedScale": 1.0,
+		"pitchScale": 0.0,
+		"intonationScale": 1.0,
+		"volumeScale": 1.0,
+		"prePhonemeLength": 0.1,
+		"postPhonemeLength": 0.1,
+		"outputSamplingRate": 24000,
+		"outputStereo": False,
+		"kana": text,
+	}
+
+
+def duration(query):
+	speed = query.get("speedScale") or 1.0
+	sec = query.get("prePhonemeLength", 0.1) + query.get("postPhonemeLength", 0.1)
+	for phrase in query["accent_phrases"]:
+		moras = list(phrase["moras"])
+		if moras and phrase.get("is_interrogative") and moras[-1]["pitch"] != 0:
+			# 合成時に語尾を上げるモーラが加わる
+			moras.append({"vowel_length": 0.15})
+		if phrase.get("pause_mora"):
+			moras.append(phrase["pause_mora"])
+		for mora in moras:
+			sec += ((mora.get("consonant_length") or 0) + mora["vowel_length"]) / speed
+	return sec
+
+
+def makeWave(query):
+	"""Returns a WAV file as long as query would be, with a constant tone and faint noise at both ends."""
+	rate = int(query.get("outputSamplingRate", 24000))
+	channels = 2 if query.get("outputStereo") else 1
+	amplitude = min(int(8000 * query.get("volumeScale", 1.0)), 32767)
+	sample = struct.pack("<h", amplitude) * channels
+	noise = struct.pack("<h", 12) * channels + struct.pack("<h", -12) * channels
+	pcm = (
+		noise * int(rate * LEAD_NOISE / 2)
+		+ sample * int(rate * duration(query))
+		+ noise * int(rate * TAIL_NOISE / 2)
+	)
+	fmt = struct.pack("<HHIIHH", 1, channels, rate, rate * 2 * channels, 2 * channels, 16)
+	info = b"INFOISFT\x06\x00\x00\x00mock\x00\x00"
+	body = (
+		b"WAVE"
+		+ b"fmt " + struct.pack("<I", len(fmt)) + fmt
+		+ b"LIST" + struct.pack("<I", len(info)) + info
+		+ b"data" + struct.pack("<I", len(pcm)) + pcm
+	)
+	return b"RIFF" + struct.pack("<I", len(body)) + body
+
+
+class Engine:
+	"""State and behaviour of a mock engine.
+
+	latency is added to every request, synthesis takes rtf times the length of the audio,
+	and the first synthesis with a style takes loadTime more, as loading its model does.
+	errorRate is the probability that a synthesis request fails with 500.
+	"""
+
+	def __init__(self, latency=0.01, rtf=0.05, errorRate=0.0, loadTime=0.0, version="0.14.8", seed=0):
+		self.latency = latency
+		self.rtf = rtf
+		self.errorRate = errorRate
+		self.loadTime = loadTime
+		self.version = version
+		self.calls = {}
+		self.errors = 0
+		self.initialized = set()
+		self.userDict = {}
+		self._lock = threading.Lock()
+		self._random = random.Random(seed)
+
+	def count(self, path):
+		with self._lock:
+			self.calls[path] = self.calls.get(path, 0) + 1
+
+	def shouldFail(self, path):
+		if not self.errorRate or path not in FAILING_PATHS:
+			return False
+		with self._lock:
+			if self._random.random() >= self.errorRate:
+				return False
+			self.errors += 1
+			return True
+
+	def load(self, speaker):
+		with self._lock:
+			if speaker in self.initialized:
+				return
+			self.initialized.add(speaker)
+		time.sleep(self.loadTime)
+
+	def getStats(self):
+		with self._lock:
+			return {"calls": dict(self.calls), "errors": self.errors}
+
+
+class _Handler(BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1"
+	# ヘッダと本文を別々に書くので、Nagleアルゴリズムで応答が遅れないようにする
+	disable_nagle_algorithm = True
+	engine = None
+
+	def log_message(self, format, *args):
+		pass
+
+	def do_GET(self):
+		self._handle("GET")
+
+	def do_POST(self):
+		self._handle("POST")
+
+	def do_PUT(self):
+		self._handle("PUT")
+
+	def do_DELETE(self):
+		self._handle("DELETE")
+
+	def _send(self, code, body=b"", contentType="application/json"):
+		self.send_response(code)
+		self.send_header("Content-Type", contentType)
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		try:
+			self.wfile.write(body)
+		except OSError:
+			# 合成を中断したクライアントが接続を切った
+			pass
+
+	def _json(self, obj):
+		self._send(200, json.dumps(obj, ensure_ascii=False).encode("utf-8"))
+
+	def _handle(self, method):
+		engine = self.engine
+		url = urllib.parse.urlparse(self.path)
+		params = dict(urllib.parse.parse_qsl(url.query))
+		path = url.path
+		length = int(self.headers.get("Content-Length") or 0)
+		body = self.rfile.read(length) if length else b""
+		engine.count(path)
+		time.sleep(engine.latency)
+		if engine.shouldFail(path):
+			self._send(500, b'{"detail":"mock failure"}')
+		elif path == "/version":
+			self._json(engine.version)
+		elif path == "/speakers":
+			self._json(SPEAKERS)
+		elif path == "/accent_phrases":
+			self._json(accentPhrases(params["text"]))
+		elif path == "/audio_query":
+			self._json(audioQuery(params["text"]))
+		elif path in ("/synthesis", "/cancellable_synthesis"):
+			engine.load(params.get("speaker"))
+			query = json.loads(body)
+			time.sleep(duration(query) * engine.rtf)
+			self._send(200, makeWave(query), "audio/wav")
+		elif path == "/multi_synthesis":
+			engine.load(params.get("speaker"))
+			buf = io.BytesIO()
+			total = 0
+			with zipfile.ZipFile(buf, "w") as z:
+				for i, query in enumerate(json.loads(body), 1):
+					total += duration(query)
+					z.writestr("%03d.wav" % i, makeWave(query))
+			time.sleep(total * engine.rtf)
+			self._send(200, buf.getvalue(), "application/zip")
+		elif path == "/initialize_speaker":
+			engine.load(params.get("speaker"))
+			self._send(204)
+		elif path == "/is_initialized_speaker":
+			self._json(params.get("speaker") in engine.initialized)
+		elif path == "/import_user_dict":
+			engine.userDict.update(json.loads(body))
+			self._send(204)
+		elif path == "/user_dict":
+			self._json(engine.userDict)
+		elif path == "/user_dict_word":
+			wordUuid = str(uuid.uuid4())
+			engine.userDict[wordUuid] = params
+			self._json(wordUuid)
+		elif path.startswith("/user_dict_word/"):
+			wordUuid = path.rsplit("/", 1)[1]
+			if method == "DELETE":
+				engine.userDict.pop(wordUuid, None)
+			else:
+				engine.userDict[wordUuid] = params
+			self._send(204)
+		else:
+			self._send(404, b'{"detail":"Not Found"}')
+
+
+class _Server(ThreadingHTTPServer):
+	daemon_threads = True
+
+	def handle_error(self, request, client_address):
+		# 中断された合成の接続が切られるのは想定どおりなので、トレースバックを出さない
+		if not isinstance(sys.exc_info()[1], ConnectionError):
+			super().handle_error(request, client_address)
+
+
+def start(port=0, **kwargs):
+	"""Starts a mock engine on localhost in a background thread and returns (server, engine).
+
+	With port 0 a free port is chosen; it is server.server_address[1]. kwargs are passed to Engine.
+	"""
+	engine = Engine(**kwargs)
+	handler = type("Handler", (_Handler,), {"engine": engine})
+	server = _Server(("127.0.0.1", port), handler)
+	threading.Thread(target=server.serve_forever, name="MockEngine", daemon=True).start()
+	return server, engine
+
+
+def main():
+	# エンジンの管理を試すために、run.exeと同じオプションで別のプロセスとして起動できるようにする
+	parser = argparse.ArgumentParser(description="Mock Voicevox engine")
+	parser.add_argument("--host", default="127.0.0.1")
+	parser.add_argument("--port", type=int, default=50021)
+	parser.add_argument("--cpu_num_threads", type=int, default=None)
+	parser.add_argument("--enable_cancellable_synthesis", action="store_true")
+	parser.add_argument("--latency", type=float, default=0.01)
+	parser.add_argument("--rtf", type=float, default=0.05, help="real-time factor with one thread")
+	parser.add_argument("--load_time", type=float, default=0.0)
+	args = parser.parse_args()
+	rtf = args.rtf
+	if args.cpu_num_threads:
+		# コア数までは速くなるが、スレッドが増えると切り替えの負担も増える
+		rtf = rtf / min(args.cpu_num_threads, os.cpu_count() or 1) + rtf * 0.02 * args.cpu_num_threads
+	engine = Engine(latency=args.latency, rtf=rtf, loadTime=args.load_time)
+	handler = type("Handler", (_Handler,), {"engine": engine})
+	_Server((args.host, args.port), handler).serve_forever()
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,343 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2026 ACT Laboratory
+"""Headless benchmark of the VSU synthesizer.
+
+The driver is run outside NVDA against a mock Voicevox engine and a fake player, both in this process,
+and scripted workloads are timed. Results are written as JSON.
+
+	python tools/benchmark/run.py [--workload sayAll] [--output result.json] [--rtf 0.05] ...
+
+Times are wall clock times in milliseconds. The fake player plays --speed times faster than real time,
+so audio lengths are reported in real seconds but take 1/speed of that to play.
+"""
+
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import sys
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(HERE, "stubs"), os.path.join(HERE, "..", "..", "addon"), HERE]
+
+import config  # noqa: E402
+import logHandler  # noqa: E402
+import mockengine  # noqa: E402
+import nvwave  # noqa: E402
+from speech.commands import IndexCommand  # noqa: E402
+from synthDrivers import _vsu  # noqa: E402
+
+# 1つの発声を待つ最大の時間(秒)
+UTTERANCE_TIMEOUT = 60.0
+# これより短い再生の途切れは数えない(秒)
+MIN_UNDERRUN = 0.001
+
+WORDS = [
+	"今日は", "明日の", "会議で", "新しい", "資料を", "確認して", "ください", "画面の", "右上にある", "ボタンを",
+	"押すと", "設定が", "開きます", "音声の", "速さや", "高さを", "変更できます", "ファイルを", "保存しました", "エラーが",
+	"発生した", "場合は", "もう一度", "お試し", "いただくか", "管理者に", "連絡して", "次の", "段落に", "進みます",
+]
+LABELS = [
+	"ファイル", "編集", "表示", "挿入", "書式", "ツール", "ヘルプ", "新規作成", "開く", "上書き保存",
+	"名前を付けて保存", "印刷", "閉じる", "元に戻す", "やり直し", "切り取り", "コピー", "貼り付け", "すべて選択", "検索",
+	"置換", "ズーム", "ステータスバー", "オプション", "バージョン情報", "OK ボタン", "キャンセル ボタン", "適用 ボタン",
+	"チェックボックス チェックなし", "編集 複数行",
+]
+TYPED_TEXT = "こんにちは、きょうはいいてんきですね。"
+
+
+class Utterance:
+	"""Timing of one speak() call, identified by the index spoken after its text."""
+
+	def __init__(self, index, text):
+		self.index = index
+		self.text = text
+		self.start = time.perf_counter()
+		self.firstAudio = None
+		self.finished = None
+		self.cancelled = False
+		self.bytes = 0
+		self.audioSeconds = 0.0
+		self.gaps = []
+		self.done = threading.Event()
+
+
+class Probe:
+	"""Attributes audio fed to the player and reached indexes to the current utterance."""
+
+	def __init__(self):
+		self.current = None
+		self._lock = threading.Lock()
+		self._nextIndex = 1
+
+	def begin(self, text):
+		with self._lock:
+			utterance = Utterance(self._nextIndex, text)
+			self._nextIndex += 1
+			self.current = utterance
+		return utterance
+
+	def onFeed(self, player, length, gap):
+		now = time.perf_counter()
+		with self._lock:
+			utterance = self.current
+			if utterance is None or utterance.done.is_set():
+				return
+			if utterance.firstAudio is None:
+				utterance.firstAudio = now - utterance.start
+			elif gap is not None and gap >= MIN_UNDERRUN:
+				# 発声の途中で、再生する音声が途切れていた
+				utterance.gaps.append(gap)
+			utterance.bytes += length
+			utterance.audioSeconds += length / player.bytesPerSec
+
+	def onIndex(self, index):
+		now = time.perf_counter()
+		with self._lock:
+			utterance = self.current
+			if utterance is None or index != utterance.index or utterance.done.is_set():
+				return
+			utterance.finished = now - utterance.start
+			utterance.done.set()
+
+
+def percentiles(values):
+	"""Returns count, mean, p50, p95, p99 and max of values given in seconds, in milliseconds."""
+	if not values:
+		return {"count": 0, "mean": None, "p50": None, "p95": None, "p99": None, "max": None}
+	values = sorted(values)
+
+	def rank(fraction):
+		return round(values[max(0, math.ceil(fraction * len(values)) - 1)] * 1000, 2)
+
+	return {
+		"count": len(values),
+		"mean": round(sum(values) / len(values) * 1000, 2),
+		"p50": rank(0.5),
+		"p95": rank(0.95),
+		"p99": rank(0.99),
+		"max": round(values[-1] * 1000, 2),
+	}
+
+
+def speak(probe, text, sequence=None):
+	utterance = probe.begin(text)
+	_vsu.speak((sequence if sequence is not None else [text]) + [IndexCommand(utterance.index)])
+	return utterance
+
+
+def interrupt(probe):
+	"""Stops speech as NVDA does before speaking something new."""
+	utterance = probe.current
+	if utterance is not None and not utterance.done.is_set():
+		utterance.cancelled = True
+	_vsu.stop()
+
+
+def summarize(utterances, wall):
+	completed = [u for u in utterances if u.finished is not None]
+	cancelled = [u for u in utterances if u.cancelled and u.finished is None]
+	audioSeconds = sum(u.audioSeconds for u in utterances)
+	return {
+		"utterances": len(utterances),
+		"completed": len(completed),
+		"cancelled": len(cancelled),
+		"cancelledBeforeAudio": len([u for u in cancelled if u.firstAudio is None]),
+		"timedOut": len([u for u in utterances if u.finished is None and not u.cancelled]),
+		"wallSeconds": round(wall, 3),
+		"audioSeconds": round(audioSeconds, 3),
+		"throughput": {
+			"utterancesPerSecond": round(len(completed) / wall, 3) if wall else None,
+			"charactersPerSecond": round(sum(len(u.text) for u in completed) / wall, 1) if wall else None,
+			# 1秒あたりに再生に渡した音声の秒数
+			"audioPerSecond": round(audioSeconds / wall, 3) if wall else None,
+		},
+		"latencyMs": percentiles([u.finished for u in completed]),
+		"firstAudioMs": percentiles([u.firstAudio for u in utterances if u.firstAudio is not None]),
+		"underruns": percentiles([gap for u in utterances for gap in u.gaps]),
+	}
+
+
+def sayAll(probe, rnd, args):
+	"""Reads a long document as one sequence, a line per index, as say all does."""
+	lines = []
+	for i in range(args.lines):
+		lines.append("".join(rnd.choice(WORDS) for j in range(rnd.randint(3, 12))) + "。")
+	text = "".join(lines)
+	sequence = []
+	for i, line in enumerate(lines):
+		# 行ごとのインデックスは、発声の終わりを示すものと重ならない番号にする
+		sequence.extend([line, IndexCommand(1000000 + i)])
+	utterance = speak(probe, text, sequence)
+	utterance.done.wait(UTTERANCE_TIMEOUT * len(lines))
+	return [utterance]
+
+
+def navigation(probe, rnd, args):
+	"""Moves through controls quickly, interrupting the previous label each time."""
+	utterances = []
+	for i in range(args.steps):
+		interrupt(probe)
+		utterances.append(speak(probe, rnd.choice(LABELS)))
+		# たまに手を止めて、最後まで聞く
+		if i % 10 == 9:
+			utterances[-1].done.wait(UTTERANCE_TIMEOUT)
+		else:
+			time.sleep(rnd.uniform(0.03, 0.3))
+	utterances[-1].done.wait(UTTERANCE_TIMEOUT)
+	return utterances
+
+
+def keyRepeat(probe, rnd, args):
+	"""Holds an arrow key down, so that a label is replaced by the next one at the key repeat rate."""
+	utterances = []
+	for i in range(args.steps):
+		interrupt(probe)
+		utterances.append(speak(probe, rnd.choice(LABELS)))
+		# 20回ごとにキーを離して、最後の項目を聞く
+		if i % 20 == 19:
+			utterances[-1].done.wait(UTTERANCE_TIMEOUT)
+		else:
+			time.sleep(rnd.uniform(0.025, 0.04))
+	utterances[-1].done.wait(UTTERANCE_TIMEOUT)
+	return utterances
+
+
+def typing(probe, rnd, args):
+	"""Echoes characters as they are typed, interrupting the previous one."""
+	utterances = []
+	for ch in TYPED_TEXT * max(1, args.steps // len(TYPED_TEXT)):
+		interrupt(probe)
+		utterances.append(speak(probe, ch))
+		time.sleep(rnd.uniform(0.08, 0.25))
+	utterances[-1].done.wait(UTTERANCE_TIMEOUT)
+	return utterances
+
+
+def voiceSwitch(probe, rnd, args):
+	"""Switches to another style before each phrase, as when comparing voices."""
+	styles = [str(style["id"]) for speaker in mockengine.SPEAKERS for style in speaker["styles"]]
+	utterances = []
+	for i in range(args.steps // 4):
+		interrupt(probe)
+		_vsu.setVoice(styles[i % len(styles)])
+		utterances.append(speak(probe, rnd.choice(LABELS) + "を選択しました。"))
+		utterances[-1].done.wait(UTTERANCE_TIMEOUT)
+	return utterances
+
+
+WORKLOADS = {
+	"sayAll": sayAll,
+	"navigation": navigation,
+	"keyRepeat": keyRepeat,
+	"typing": typing,
+	"voiceSwitch": voiceSwitch,
+}
+
+
+def _reset():
+	# 前のワークロードの音声やキャッシュを引き継がない
+	_vsu.stop()
+	for cache in (_vsu.waveCache, _vsu.queryCache, _vsu.phraseCache):
+		if cache is not None:
+			cache.clear()
+	_vsu.resetStats()
+	logHandler.counter.counts.clear()
+
+
+def runWorkload(name, probe, engine, args):
+	_reset()
+	before = engine.getStats()
+	rnd = random.Random(args.seed)
+	start = time.perf_counter()
+	utterances = WORKLOADS[name](probe, rnd, args)
+	wall = time.perf_counter() - start
+	interrupt(probe)
+	after = engine.getStats()
+	result = summarize(utterances, wall)
+	result["engine"] = {
+		"calls": {path: count - before["calls"].get(path, 0) for path, count in after["calls"].items()
+			if count != before["calls"].get(path, 0)},
+		"errors": after["errors"] - before["errors"],
+	}
+	result["log"] = dict(logHandler.counter.counts)
+	result["driver"] = _vsu.getStats()
+	return result
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Runs VSU against a mock engine and reports latency and throughput as JSON.")
+	parser.add_argument("--workload", action="append", choices=sorted(WORKLOADS),
+		help="workload to run; may be repeated. All workloads are run by default")
+	parser.add_argument("--output", help="file to write the results to instead of standard output")
+	parser.add_argument("--trace", help="file to write a Chrome trace of the last workload to; sets traceSize if it is 0")
+	parser.add_argument("--latency", type=float, default=0.005, help="seconds added to every engine request")
+	parser.add_argument("--rtf", type=float, default=0.03, help="synthesis time divided by the length of the audio")
+	parser.add_argument("--error-rate", type=float, default=0.0, help="probability that a synthesis request fails")
+	parser.add_argument("--load-time", type=float, default=0.3, help="seconds the first synthesis with a style takes more")
+	parser.add_argument("--speed", type=float, default=20.0, help="how many times faster than real time the fake player plays")
+	parser.add_argument("--lines", type=int, default=40, help="number of lines read by sayAll")
+	parser.add_argument("--steps", type=int, default=60, help="number of steps of the interactive workloads")
+	parser.add_argument("--seed", type=int, default=0)
+	parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE",
+		help="overrides a VSU_synth setting, e.g. --set batchSize=1; may be repeated")
+	args = parser.parse_args()
+
+	server, engine = mockengine.start(latency=args.latency, rtf=args.rtf, errorRate=args.error_rate, loadTime=args.load_time,
+		seed=args.seed)
+	nvwave.speed = args.speed
+	probe = Probe()
+	nvwave.onFeed = probe.onFeed
+	settings = config.conf["VSU_synth"]
+	settings["endpoints"] = ["127.0.0.1:%d" % server.server_address[1]]
+	# 実行のたびに結果が変わらないよう、ディスクキャッシュは既定で使わない
+	settings["diskCacheSize"] = 0
+	# 前回使った話者として、最初の話者を起動時に読み込ませる
+	settings["recentStyles"] = ["1"]
+	for item in args.set:
+		key, value = item.split("=", 1)
+		default = settings[key]
+		if isinstance(default, bool):
+			value = value.lower() in ("1", "true", "yes")
+		elif isinstance(default, list):
+			value = [v for v in value.split(",") if v]
+		elif default is not None:
+			value = type(default)(value)
+		settings[key] = value
+	if args.trace and not settings["traceSize"]:
+		settings["traceSize"] = 100000
+	_vsu.initialize(probe.onIndex)
+	_vsu.warmQueue.join()
+	results = {}
+	try:
+		for name in args.workload or list(WORKLOADS):
+			# トレースは最後のワークロードの分だけ残す
+			_vsu.tracer.clear()
+			results[name] = runWorkload(name, probe, engine, args)
+		if args.trace:
+			with open(args.trace, "w", encoding="utf-8") as f:
+				json.dump(_vsu.getTrace(), f)
+	finally:
+		_vsu.terminate()
+		server.shutdown()
+	output = {
+		"time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+		"python": platform.python_version(),
+		"options": {key: value for key, value in vars(args).items() if key not in ("output", "trace", "workload")},
+		"settings": {key: settings[key] for key in sorted(_vsu.confspec)},
+		"workloads": results,
+	}
+	text = json.dumps(output, ensure_ascii=False, indent="\t")
+	if args.output:
+		with open(args.output, "w", encoding="utf-8") as f:
+			f.write(text + "\n")
+	else:
+		print(text)
+
+
+if __name__ == "__main__":
+	main()
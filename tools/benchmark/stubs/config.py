@@ -0,0 +1,39 @@
+# Copyright (C) 2026 ACT Laboratory
+# ベンチマーク用の、NVDAのconfigモジュールの代わり
+
+import re
+
+
+class _Section(dict):
+	"""A section of config.conf that fills in defaults from its spec on first access."""
+
+	def __init__(self, spec=None):
+		super().__init__()
+		self.spec = spec if spec is not None else {}
+
+	def __getitem__(self, key):
+		if key not in self and key in self.spec:
+			spec = self.spec[key]
+			dict.__setitem__(self, key, _Section(spec) if isinstance(spec, dict) else _default(spec))
+		return dict.__getitem__(self, key)
+
+
+def _default(spec):
+	kind = spec.split("(", 1)[0]
+	match = re.search(r"default=(list\([^)]*\)|'[^']*'|\"[^\"]*\"|[^,)]*)", spec)
+	if not match:
+		return None
+	raw = match.group(1)
+	if kind == "integer":
+		return int(raw)
+	if kind == "float":
+		return float(raw)
+	if kind == "boolean":
+		return raw == "True"
+	if raw.startswith("list("):
+		return [item.strip(" '\"") for item in raw[5:-1].split(",") if item.strip(" '\"")]
+	return raw.strip("'\"")
+
+
+conf = _Section()
+dict.__setitem__(conf, "speech", {"outputDevice": ""})
@@ -0,0 +1,7 @@
+# Copyright (C) 2026 ACT Laboratory
+# ベンチマーク用の、NVDAのglobalVarsモジュールの代わり
+
+import tempfile
+import types
+
+appArgs = types.SimpleNamespace(configPath=tempfile.mkdtemp(prefix="vsu-bench-"), secure=False)
@@ -0,0 +1,21 @@
+# Copyright (C) 2026 ACT Laboratory
+# ベンチマーク用の、NVDAのlogHandlerモジュールの代わり
+
+import logging
+
+
+class _CountingHandler(logging.Handler):
+	"""Counts warnings and errors logged by the driver."""
+
+	def __init__(self):
+		super().__init__(logging.WARNING)
+		self.counts = {}
+
+	def emit(self, record):
+		self.counts[record.levelname] = self.counts.get(record.levelname, 0) + 1
+
+
+log = logging.getLogger("nvda")
+log.setLevel(logging.WARNING)
+counter = _CountingHandler()
+log.addHandler(counter)
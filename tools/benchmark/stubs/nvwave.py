@@ -0,0 +1,90 @@
+# Copyright (C) 2026 ACT Laboratory
+# ベンチマーク用の、NVDAのnvwaveモジュールの代わり。音は出さず、再生にかかる時間だけ待つ
+
+import ctypes
+import threading
+import time
+from collections import deque
+
+# 実際の再生より何倍速く再生したことにするか
+speed = 20.0
+# feed()のたびに(player, バイト数, 再生が途切れていた秒数またはNone)で呼ばれる
+onFeed = None
+
+
+class WavePlayer:
+	"""Fake player that takes len(data) / bytesPerSec / speed seconds to play each block.
+
+	Like nvwave, feed() blocks while a block is already waiting, and onDone is called when a block has been played.
+	"""
+
+	def __init__(self, channels, samplesPerSec, bitsPerSample, outputDevice=None, buffered=False, **kwargs):
+		self.samplesPerSec = samplesPerSec
+		self.bytesPerSec = channels * samplesPerSec * bitsPerSample // 8
+		self.fed = 0
+		self._queue = deque()
+		self._cv = threading.Condition()
+		self._closed = False
+		# 再生待ちがなくなった時刻
+		self._idleSince = None
+		self._thread = threading.Thread(target=self._run, name="FakeWavePlayer", daemon=True)
+		self._thread.start()
+
+	def _run(self):
+		while True:
+			with self._cv:
+				while not self._queue and not self._closed:
+					self._cv.wait()
+				if self._closed:
+					return
+				data, onDone = self._queue[0]
+				end = time.perf_counter() + len(data) / self.bytesPerSec / speed
+				# stop()されるか、再生し終わるまで待つ
+				while not self._closed and self._queue and self._queue[0][0] is data and time.perf_counter() < end:
+					self._cv.wait(end - time.perf_counter())
+				if not self._queue or self._queue[0][0] is not data:
+					continue
+				self._queue.popleft()
+				if not self._queue:
+					self._idleSince = time.perf_counter()
+				self._cv.notify_all()
+			if onDone is not None:
+				onDone()
+
+	def feed(self, data, size=None, onDone=None):
+		if isinstance(data, ctypes.c_void_p):
+			data = ctypes.string_at(data.value, size)
+		else:
+			data = bytes(data)
+		with self._cv:
+			gap = None
+			if not self._queue and self._idleSince is not None:
+				gap = time.perf_counter() - self._idleSince
+			self._idleSince = None
+			self.fed += len(data)
+			self._queue.append((data, onDone))
+			self._cv.notify_all()
+		if onFeed is not None:
+			onFeed(self, len(data), gap)
+		with self._cv:
+			while len(self._queue) > 1 and not self._closed:
+				self._cv.wait()
+
+	def idle(self):
+		with self._cv:
+			while self._queue and not self._closed:
+				self._cv.wait()
+
+	def stop(self):
+		with self._cv:
+			self._queue.clear()
+			self._idleSince = None
+			self._cv.notify_all()
+
+	def pause(self, switch):
+		pass
+
+	def close(self):
+		with self._cv:
+			self._closed = True
+			self._cv.notify_all()
@@ -0,0 +1,2 @@
+# Copyright (C) 2026 ACT Laboratory
+# ベンチマーク用の、NVDAのspeechパッケージの代わり
@@ -0,0 +1,29 @@
+# Copyright (C) 2026 ACT Laboratory
+# ベンチマーク用の、NVDAのspeech.commandsモジュールの代わり
+
+
+class IndexCommand:
+	def __init__(self, index):
+		self.index = index
+
+
+class BreakCommand:
+	def __init__(self, time=0):
+		self.time = time
+
+
+class PitchCommand:
+	def __init__(self, offset=0, multiplier=1.0, newValue=50):
+		self.newValue = newValue
+
+
+class RateCommand:
+	pass
+
+
+class VolumeCommand:
+	pass
+
+
+class PhonemeCommand:
+	pass
@@ -0,0 +1,26 @@
+# Copyright (C) 2026 ACT Laboratory
+# ベンチマーク用の、NVDAのsynthDriverHandlerモジュールの代わり
+
+
+class VoiceInfo:
+	def __init__(self, id, displayName, language=None):
+		self.id = id
+		self.displayName = displayName
+		self.language = language
+
+
+class _Action:
+	def notify(self, **kwargs):
+		pass
+
+
+class SynthDriver:
+	pass
+
+
+synthIndexReached = _Action()
+synthDoneSpeaking = _Action()
+
+
+def getSynth():
+	return None